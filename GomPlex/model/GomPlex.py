@@ -3,75 +3,437 @@
 #  Author: Max W. Y. Lam (maxingaussian@gmail.com)
 ################################################################################
 
+import time
 import random
+import hashlib
+import warnings
 import numpy as np
 import numpy.random as npr
-from scipy import linalg
-from .. import Scaler, Metric, Trainer, Visualizer
+from scipy import linalg, sparse
+from .. import Scaler, Metric, Trainer, Visualizer, Telemetry
+from .. import ToeplitzOperator, FastfoodOperator, nfft, adj_nfft, Chunker
+from .. import blocked_gram
+from collections import OrderedDict
 
 class GomPlex(object):
     
     noise_imag, noise_real, kernel_scale, spectral_freqs = 0., 0., None, None
     X, y = None, None
     X_scaler, y_scaler = None, None
-    grad_epsilon = 1e-8
+    grad_epsilon, spsa_epsilon = 1e-8, 1e-4
+    grad_estimators = ['coordinate', 'spsa', 'random']
+    grow_candidates, grow_step, grow_patience, grow_valid_ratio = 32, 1, 3, .2
+    prune_merge_tol = 1e-3
+    init_strategies = ['random', 'periodogram', 'sobol', 'halton']
+    periodogram_bins = 256
+    cache_size, cache_bytes, data_version = 32, 2**26, 0
+    fidelity, subsample_index = 1., None
+    full_weights, row_weights, coreset_report = None, None, None
+    train_Phi, inv_K = None, None
+    projection_state = None
+    fastfood, fastfood_op, fastfood_gemm_ratio = False, None, 40
+    real_output = False
+    gram_tile_size, gram_threads = 2048, 1
+    aggregate_duplicates = False
+    trained_attrs = ['N', 'T', 'inv_A', 'alpha', 'log_det_A', 'train_Phi',
+        'inv_K']
     
-    def __init__(self, sparsity=20, mean_only=False):
+    def __init__(self, sparsity=20, mean_only=False, freqs_lattice=False,
+        fastfood=False):
+        assert not (freqs_lattice and fastfood),\
+            "Lattice and Fastfood frequencies are exclusive!"
         self.M = sparsity
         self.mean_only = mean_only
+        self.freqs_lattice = freqs_lattice
+        self.fastfood = fastfood
         self.hashed_name = ''.join(npr.choice(list('ABCDEFGH'), 5))+str(self.M)
         self.visualizer = Visualizer(self)
+        self.telemetry = Telemetry()
+        self.clear_cache()
     
     def __str__(self):
         return "GomPlex-%d" % (self.M)
     
     def fit(self, X, y,
         cost_type='nlml', cv_folds=1, freqs_update_rate=0.2, opt_rate=1,
-        max_iter=500, iter_tol=30, diff_tol=1e-3, early_stop=10, plot=False):
+        max_iter=500, iter_tol=30, diff_tol=1e-3, early_stop=10, plot=False,
+        optimizer='adaptive', time_budget=None, checkpoint_path=None,
+        checkpoint_every=10, resume_from=None, grad_estimator='coordinate',
+        grad_directions=1, subsample=None, subsample_growth=2.,
+        grow_basis=None, init='random', aggregate_duplicates=False,
+        coreset=None):
+        assert grad_estimator in self.grad_estimators,\
+            "Invalid gradient estimator!"
+        assert init in self.init_strategies, "Invalid initialization!"
+        assert not aggregate_duplicates or not (self.freqs_lattice or
+            sparse.issparse(X)), "Duplicate aggregation needs dense inputs!"
+        assert coreset is None or not (self.freqs_lattice or
+            resume_from is not None), "Coreset needs a fresh non-lattice fit!"
+        self.aggregate_duplicates = aggregate_duplicates
         self.freqs_update_rate = freqs_update_rate
+        self.grad_estimator = grad_estimator
+        self.grad_directions = grad_directions
+        self.subsample_growth = subsample_growth
         self.cost_type = cost_type
         self.cv_folds = cv_folds
         self.X_scaler = Scaler('minmax', X)
         self.y_scaler = Scaler('normal', y)
-        self.X = self.X_scaler.eval(X)
-        self.y = self.y_scaler.eval(y)
+        self.clear_cache()
+        self.data_version += 1
+        if(sparse.issparse(X)):
+            # CSR inputs stay unscaled, the minmax scaling is folded into the
+            # projection so zeros are never materialized
+            self.full_X = sparse.csr_matrix(X, dtype=np.float64)
+        else:
+            self.full_X = self.X_scaler.eval(X)
+        self.full_y = self.y_scaler.eval(y)
+        self.full_weights, self.coreset_report = None, None
+        self.real_output = not self.freqs_lattice and not np.any(np.iscomplex(y))
+        self.set_fidelity(1.)
         self.D = self.X.shape[1]
-        if(self.spectral_freqs is None):
-            self.init_hyperparams()
+        if(self.fastfood and (self.fastfood_op is None or
+            self.fastfood_op.D != self.D)):
+            self.fastfood_op = FastfoodOperator(self.D, self.M)
+        if(self.spectral_freqs is None or resume_from is not None):
+            if(resume_from is None):
+                if(subsample is not None):
+                    self.set_fidelity(subsample)
+                self.init_hyperparams(strategy=init)
+                if(grow_basis is not None):
+                    self.grow(grow_basis)
+                if(coreset is not None):
+                    full_data = (self.full_X, self.full_y)
+                    self.set_coreset(coreset, coreset.size, *full_data)
             train_params = [opt_rate, max_iter, iter_tol, diff_tol, early_stop]
-            trainer = Trainer(self, *train_params)
-            trainer.train(self.visualizer.plot_training() if plot else None)
+            def monitor(trainer):
+                # Periodic checks only pay off while the coreset can grow
+                report = self.coreset_report
+                return report['sample_size'] < report['max_size'] and\
+                    self.check_coreset(coreset, *full_data)
+            trainer = Trainer(self, *train_params,
+                optimizer=optimizer, time_budget=time_budget,
+                checkpoint_path=checkpoint_path,
+                checkpoint_every=checkpoint_every,
+                monitor=None if coreset is None else monitor,
+                monitor_every=None if coreset is None else coreset.check_every)
+            animate = self.visualizer.plot_training() if plot else None
+            try:
+                trainer.train(animate, resume_from)
+                while(coreset is not None and
+                    self.refine_coreset(coreset, trainer, *full_data)):
+                    trainer.train(animate)
+            finally:
+                # Also on an interrupt, which the trainer passes on
+                if(plot):
+                    self.visualizer.stop()
+                if(coreset is not None):
+                    self.unset_coreset(coreset, *full_data)
         else:
             self.train()
         return self
     
-    def predict(self, new_X, scaled=True):
-        X = np.array(new_X).copy()
-        if(scaled):
-            X = self.X_scaler.eval(X)
-        X_sparse = X.dot(self.spectral_freqs)
+    def predict(self, new_X, scaled=True, return_std=True):
+        if(sparse.issparse(new_X)):
+            X = sparse.csr_matrix(new_X, dtype=np.float64)
+        else:
+            X = np.array(new_X).copy()
+            if(scaled):
+                X = self.X_scaler.eval(X)
         Phi_const = np.sqrt(self.kernel_scale/self.M)
-        Phi = Phi_const*np.exp(-2j*np.pi*X_sparse)
-        mu = Phi.dot(self.alpha)
+        if(self.freqs_lattice):
+            Phi = None
+            mu = Phi_const*self.lattice_nfft(X, self.alpha.ravel())[:, None]
+        else:
+            X_sparse = self.project(X)
+            Phi = Phi_const*np.exp(-2j*np.pi*X_sparse)
+            mu = Phi.dot(self.alpha)
+        # Lattice models keep complex features even for real targets
+        if(self.real_output or not np.iscomplexobj(self.y)):
+            mu = mu.real
         if(scaled):
             mu = self.y_scaler.eval(mu, inv=True)
+            if(self.real_output):
+                mu = mu.real
         noise = self.noise_real+self.noise_imag*1j
-        if(self.mean_only):
+        if(self.mean_only or not return_std):
             std = np.ones_like(mu)
             if(scaled):
-                std *= (self.y_scaler._r_std_+self.y_scaler._i_std_*1j)
+                std *= self.get_y_std_scale()
             return mu, std
-        std = np.sqrt(noise*(1+np.diagonal(
-            Phi.dot(self.inv_A.dot(Phi.conj().T)))))[:, None]
+        if(self.real_output):
+            Phi_real = self.get_real_features(Phi)
+            Phi_inv_A_Phi_H = np.sum(Phi_real.dot(self.inv_A)*Phi_real, 1)
+            std = np.sqrt(self.noise_real*(1+Phi_inv_A_Phi_H))[:, None]
+            if(scaled):
+                std *= self.get_y_std_scale()
+            return mu, std
+        if(self.freqs_lattice):
+            # inv(A) by its circulant preconditioner like log|A| in training:
+            # FFTs of tiles of test points instead of a CG solve per point
+            C = self.T.get_circulant_preconditioner()
+            Phi_inv_A_Phi_H = np.empty(X.shape[0], dtype=np.complex128)
+            tile_size = max(2**20//self.M, 1)
+            for st in range(0, X.shape[0], tile_size):
+                Phi = Phi_const*np.exp(-2j*np.pi*
+                    X[st:st+tile_size].dot(self.spectral_freqs))
+                Phi_inv_A_Phi_H[st:st+tile_size] = np.sum(
+                    Phi*C.solve(Phi.conj().T).T, 1)
+        elif(self.inv_A is None):
+            Phi_Phi_H = Phi.dot(self.train_Phi.conj().T)
+            Phi_inv_A_Phi_H = (np.sum(np.absolute(Phi)**2, 1)-np.sum(
+                Phi_Phi_H.dot(self.inv_K)*Phi_Phi_H.conj(), 1))/noise
+        else:
+            Phi_inv_A_Phi_H = np.sum(Phi.dot(self.inv_A)*Phi.conj(), 1)
+        std = np.sqrt(noise*(1+Phi_inv_A_Phi_H))[:, None]
         if(scaled):
-            std *= (self.y_scaler._r_std_+self.y_scaler._i_std_*1j)
+            std *= self.get_y_std_scale()
         return mu, std
-    
-    def init_hyperparams(self, rand_num=1):
+
+    def get_y_std_scale(self):
+        # Real targets leave the scaler without imaginary statistics
+        i_std = getattr(self.y_scaler, '_i_std_', None)
+        if(self.real_output or i_std is None):
+            return self.y_scaler._r_std_
+        return self.y_scaler._r_std_+i_std*1j
+
+    def get_projection(self):
+        # Minmax scaling folded into the frequencies: (x-min)/range-.5
+        # projected on W is x.(W/range)-(min/range+.5).W, valid as long as
+        # the trained state (alpha) and the scalers are the same objects
+        state = self.projection_state
+        if(state is not None and state['alpha'] is self.alpha and
+            state['X_scaler'] is self.X_scaler and
+            state['y_scaler'] is self.y_scaler):
+            return state
+        x_range = self.X_scaler._r_max_-self.X_scaler._r_min_
+        freqs = self.spectral_freqs.real
+        Phi_const = np.sqrt(self.kernel_scale/self.M)
+        inv_A = self.inv_A
+        if(inv_A is None and self.inv_K is not None):
+            # Woodbury in the dual solve, formed once as an M x M matrix
+            noise = self.noise_real+self.noise_imag*1j
+            inv_A = (np.eye(self.M)-self.train_Phi.conj().T.dot(
+                self.inv_K).dot(self.train_Phi))/noise
+        self.projection_state = {
+            'alpha':self.alpha,
+            'X_scaler':self.X_scaler,
+            'y_scaler':self.y_scaler,
+            'W':np.ascontiguousarray(-2*np.pi*freqs/x_range[:, None]),
+            'bias':2*np.pi*(self.X_scaler._r_min_/x_range+.5).dot(freqs),
+            'alpha_scaled':Phi_const*self.alpha.ravel(),
+            'inv_A_scaled':None if inv_A is None else\
+                np.ascontiguousarray(Phi_const**2*inv_A),
+            'buffers':{},
+        }
+        return self.projection_state
+
+    def get_predict_buffers(self, batch_size):
+        # Work buffers are kept per model and per batch size
+        buffers = self.get_projection()['buffers']
+        if(batch_size not in buffers):
+            buffers[batch_size] = {
+                'theta':np.empty((batch_size, self.M)),
+                'Phi':np.empty((batch_size, self.M), dtype=np.complex128),
+                'Phi_inv_A':np.empty((batch_size, 2*self.M)) if
+                    self.real_output else np.empty((batch_size, self.M),
+                    dtype=np.complex128),
+                'mu':np.empty(batch_size, dtype=np.complex128),
+                'q_real':np.empty(batch_size),
+                'q_imag':np.empty(batch_size),
+            }
+        return buffers[batch_size]
+
+    def predict_fast(self, new_X, out=None, std_out=None, return_std=True,
+        batch_size=4096):
+        # Real inputs are never copied or upcast to complex: the scaled
+        # projection is one GEMM per batch into a reused buffer, cos/sin are
+        # written straight into Phi and results into the out arrays
+        X = new_X if sparse.issparse(new_X) else np.asarray(new_X)
+        if(np.iscomplexobj(X) or self.freqs_lattice or
+            hasattr(self.X_scaler, '_i_min_')):
+            mu, std = self.predict(X, True, return_std)
+            if(out is None):
+                return mu, std
+            out[:] = mu
+            if(std_out is not None):
+                std_out[:] = std
+            return out, std_out
+        N, M = X.shape[0], self.M
+        # Real-output models predict real means and stds like predict()
+        dtype = np.float64 if self.real_output else np.complex128
+        if(out is None):
+            out = np.empty((N, 1), dtype=dtype)
+        if(std_out is None):
+            std_out = np.empty((N, 1), dtype=dtype)
+        proj = self.get_projection()
+        y_scaler = self.y_scaler
+        r_std, r_mu = np.ravel(y_scaler._r_std_)[0], np.ravel(y_scaler._r_mu_)[0]
+        i_std = np.ravel(getattr(y_scaler, '_i_std_', 0.))[0]
+        i_mu = np.ravel(getattr(y_scaler, '_i_mu_', 0.))[0]
+        noise = self.noise_real+self.noise_imag*1j
+        buf = self.get_predict_buffers(batch_size)
+        for st in range(0, N, batch_size):
+            ed = min(st+batch_size, N)
+            n = ed-st
+            theta, Phi, mu = buf['theta'][:n], buf['Phi'][:n], buf['mu'][:n]
+            if(sparse.issparse(X)):
+                theta[:] = X[st:ed].dot(proj['W'])
+            else:
+                np.dot(X[st:ed], proj['W'], out=theta)
+            theta += proj['bias']
+            np.cos(theta, out=Phi.real)
+            np.sin(theta, out=Phi.imag)
+            np.dot(Phi, proj['alpha_scaled'], out=mu)
+            mu_out = out[st:ed, 0]
+            np.multiply(mu.real, r_std, out=mu_out.real)
+            mu_out.real += r_mu
+            if(not self.real_output):
+                np.multiply(mu.imag, i_std, out=mu_out.imag)
+                mu_out.imag += i_mu
+            elif(np.iscomplexobj(mu_out)):
+                mu_out.imag = 0
+            std_batch = std_out[st:ed, 0]
+            if(self.mean_only or not return_std):
+                std_batch[:] = r_std if self.real_output else r_std+i_std*1j
+                continue
+            if(self.real_output):
+                # f inv(A) f^T with f = [cos, -sin] = [Re(Phi), -Im(Phi)]
+                F_inv_A, q_real = buf['Phi_inv_A'][:n], buf['q_real'][:n]
+                inv_A = proj['inv_A_scaled']
+                np.dot(Phi.real, inv_A[:M], out=F_inv_A)
+                F_inv_A -= Phi.imag.dot(inv_A[M:])
+                np.einsum('ij,ij->i', F_inv_A[:, :M], Phi.real, out=q_real)
+                q_real -= np.einsum('ij,ij->i', F_inv_A[:, M:], Phi.imag)
+                q_real += 1
+                q_real *= self.noise_real
+                np.sqrt(q_real, out=q_real)
+                std_batch[:] = q_real*r_std
+                continue
+            # diag(Phi inv(A) Phi^H) row by row, real and imaginary parts
+            Phi_inv_A = buf['Phi_inv_A'][:n]
+            q_real, q_imag = buf['q_real'][:n], buf['q_imag'][:n]
+            np.dot(Phi, proj['inv_A_scaled'], out=Phi_inv_A)
+            np.einsum('ij,ij->i', Phi_inv_A.real, Phi.real, out=q_real)
+            q_real += np.einsum('ij,ij->i', Phi_inv_A.imag, Phi.imag)
+            np.einsum('ij,ij->i', Phi_inv_A.imag, Phi.real, out=q_imag)
+            q_imag -= np.einsum('ij,ij->i', Phi_inv_A.real, Phi.imag)
+            std_batch.real = 1+q_real
+            std_batch.imag = q_imag
+            std_batch *= noise
+            np.sqrt(std_batch, out=std_batch)
+            std_batch *= r_std+i_std*1j
+        return out, std_out
+
+    def predict_iter(self, source, return_std=True, chunk_size=65536,
+        prefetch=2, batch_size=4096, **chunker_args):
+        # Arrays, memmaps, .npy/CSV paths or iterators of chunks, the next
+        # chunk is decoded on a background thread while this one is scored
+        if(not isinstance(source, Chunker)):
+            source = Chunker(source, chunk_size, prefetch, **chunker_args)
+        for chunk in source:
+            yield self.predict_fast(chunk, return_std=return_std,
+                batch_size=batch_size)
+
+    def predict_to(self, path, source, return_std=True, chunk_size=65536,
+        prefetch=2, batch_size=4096, **chunker_args):
+        # Streams [mu, std] rows to a complex (N, 2) .npy or a CSV file, the
+        # .npy header is rewritten with the final row count at the end
+        chunks = self.predict_iter(source, return_std, chunk_size, prefetch,
+            batch_size, **chunker_args)
+        N = 0
+        with open(path, 'wb') as out_f:
+            if(path.endswith('.npy')):
+                out_f.write(self.get_npy_header(N))
+                for mu, std in chunks:
+                    out_f.write(np.hstack((mu, std)).astype('<c16').tobytes())
+                    N += mu.shape[0]
+                out_f.seek(0)
+                out_f.write(self.get_npy_header(N))
+            else:
+                out_f.write(b'mu_real,mu_imag,std_real,std_imag\n')
+                for mu, std in chunks:
+                    np.savetxt(out_f, np.hstack((mu.real, mu.imag,
+                        std.real, std.imag)), delimiter=',')
+                    N += mu.shape[0]
+        return N
+
+    def get_npy_header(self, N, header_size=128):
+        # Fixed size so the final shape fits in the space reserved up front
+        header = "{'descr': '<c16', 'fortran_order': False, 'shape': (%d, 2), }"%(N)
+        header = header.ljust(header_size-10-1)+'\n'
+        return b'\x93NUMPY\x01\x00'+np.uint16(len(header)).tobytes()+\
+            header.encode('latin1')
+
+    def predict_counterfactual(self, new_X, column, values, scaled=True,
+        return_std=True):
+        # Setting X[:, column] = v multiplies the basis m of every row by the
+        # same phase exp(-2j*pi*v*W[column, m]), so Phi is built once with the
+        # column zeroed and the K scenarios are one (N, M) x (M, K) product
+        assert not self.freqs_lattice, "Lattice frequencies are not supported!"
+        assert not sparse.issparse(new_X), "Counterfactuals need dense inputs!"
+        X = np.array(new_X).copy()
+        values = np.asarray(values)
+        if(scaled):
+            rows = np.repeat(X[:1], len(values), 0)
+            rows[:, column] = values
+            values = self.X_scaler.eval(rows)[:, column]
+            X = self.X_scaler.eval(X)
+        X[:, column] = 0
+        Phi_const = np.sqrt(self.kernel_scale/self.M)
+        Phi = Phi_const*np.exp(-2j*np.pi*X.dot(self.spectral_freqs))
+        R = np.exp(-2j*np.pi*np.outer(self.spectral_freqs[column], values))
+        mus = Phi.dot(self.alpha*R).T[:, :, None]
+        if(self.real_output or not np.iscomplexobj(self.y)):
+            mus = mus.real
+        if(scaled):
+            mus = self.y_scaler.eval(mus, inv=True)
+            if(self.real_output):
+                mus = mus.real
+        if(self.mean_only or not return_std):
+            stds = np.ones_like(mus)
+            if(scaled):
+                stds *= self.get_y_std_scale()
+            return mus, stds
+        noise = self.noise_real+self.noise_imag*1j
+        stds = np.empty(mus.shape, dtype=np.float64 if self.real_output else
+            np.complex128)
+        for k in range(len(values)):
+            if(self.real_output):
+                Phi_real = self.get_real_features(Phi*R[:, k])
+                Phi_inv_A_Phi_H = np.sum(Phi_real.dot(self.inv_A)*Phi_real, 1)
+                stds[k] = np.sqrt(self.noise_real*(1+Phi_inv_A_Phi_H))[:, None]
+                continue
+            if(self.inv_A is None):
+                Phi_Phi_H = Phi.dot(R[:, k][:, None]*self.train_Phi.conj().T)
+                Phi_inv_A_Phi_H = (np.sum(np.absolute(Phi)**2, 1)-np.sum(
+                    Phi_Phi_H.dot(self.inv_K)*Phi_Phi_H.conj(), 1))/noise
+            else:
+                inv_A = R[:, k][:, None]*self.inv_A*R[:, k].conj()
+                Phi_inv_A_Phi_H = np.sum(Phi.dot(inv_A)*Phi.conj(), 1)
+            stds[k] = np.sqrt(noise*(1+Phi_inv_A_Phi_H))[:, None]
+        if(scaled):
+            stds *= self.get_y_std_scale()
+        return mus, stds
+
+    def init_hyperparams(self, rand_num=1, strategy='random'):
         best_cost = np.Infinity
         best_hyperparams = None
         for _ in range(rand_num):
-            hyperparams = npr.randn(3+self.D*self.M)
+            hyperparams = npr.randn(self.get_hyperparams_size())
+            if(self.freqs_lattice):
+                hyperparams[3] -= np.log(self.M)/2
+            elif(self.fastfood):
+                assert strategy == 'random',\
+                    "Fastfood frequencies only support random initialization!"
+                self.fastfood_op.init_diagonals()
+                hyperparams[3:] = np.concatenate(
+                    [self.fastfood_op.G, self.fastfood_op.S])
+            elif(strategy != 'random'):
+                assert not sparse.issparse(self.X),\
+                    "Data-driven initialization needs dense inputs!"
+                hyperparams[:3] = self.get_linear_fit_noise_init()
+                init_freqs = getattr(self, 'get_'+strategy+'_freqs_init')()
+                hyperparams[3:] = np.reshape(init_freqs, (self.D*self.M,))
             self.set_hyperparams(hyperparams)
             cost = self.get_cost()
             if(cost < best_cost):
@@ -79,83 +441,685 @@ class GomPlex(object):
                 best_hyperparams = hyperparams
         self.set_hyperparams(best_hyperparams)
 
+    def grow(self, max_sparsity):
+        # Greedy forward selection of spectral frequencies: candidates are
+        # scored by the drop of the data fit term from a bordered (rank-one)
+        # update of inv(A), growth stops when the held-out MSE stalls
+        assert not self.freqs_lattice, "Lattice frequencies cannot grow!"
+        assert not self.fastfood, "Fastfood frequencies cannot grow!"
+        valid_size = max(int(self.X.shape[0]*self.grow_valid_ratio), 1)
+        perm = npr.permutation(self.X.shape[0])
+        X_valid, y_valid = self.X[perm[:valid_size]], self.y[perm[:valid_size]]
+        X_train, y_train = self.X[perm[valid_size:]], self.y[perm[valid_size:]]
+        # Keep the per-basis scale fixed so that growing M is a pure border
+        Phi_const = np.sqrt(self.kernel_scale/self.M)
+        def get_Phi(X, freqs):
+            Phi = Phi_const*np.exp(-2j*np.pi*self.project(X, freqs))
+            return self.get_real_features(Phi) if self.real_output else Phi
+        noise, width = self.noise_real+self.noise_imag*1j, 1
+        # Real-output models add a [cos, sin] pair of columns per frequency,
+        # so every candidate borders A by a block of width 2 instead of 1
+        if(self.real_output):
+            noise, width = self.noise_real, 2
+            y_train, y_valid = y_train.real, y_valid.real
+        freqs = self.spectral_freqs.copy()
+        freqs_std = np.std(freqs)+1e-8
+        Phi, Phi_valid = get_Phi(X_train, freqs), get_Phi(X_valid, freqs)
+        inv_A = linalg.inv(Phi.conj().T.dot(Phi)+noise*np.eye(Phi.shape[1]))
+        PhiHy = Phi.conj().T.dot(y_train)
+        alpha = inv_A.dot(PhiHy)
+        get_valid_cost = lambda alpha:Metric('mse').eval(
+            y_valid, Phi_valid.dot(alpha), None)
+        best_cost, best_M, stall = get_valid_cost(alpha), freqs.shape[1], 0
+        K, eye = self.grow_candidates, np.eye(width)
+        cols = np.arange(K)[:, None]+K*np.arange(width)
+        while(freqs.shape[1] < max_sparsity and stall < self.grow_patience):
+            cand_freqs = npr.randn(self.D, K)*freqs_std
+            cand_Phi = get_Phi(X_train, cand_freqs)
+            cand_Phi_valid = get_Phi(X_valid, cand_freqs)
+            B = Phi.conj().T.dot(cand_Phi)
+            cand_blocks = cand_Phi[:, cols]
+            schur = np.einsum('nki,nkj->kij', cand_blocks.conj(), cand_blocks)+\
+                noise*eye-np.einsum('mki,mkj->kij', B[:, cols].conj(),
+                inv_A.dot(B)[:, cols])
+            residual = y_train-Phi.dot(alpha)
+            g = np.einsum('nki,n->ki', cand_blocks.conj(), residual.ravel())
+            scores = np.absolute(np.einsum('ki,ki->k', g.conj(),
+                np.linalg.solve(schur, g[:, :, None])[:, :, 0]))
+            step = min(self.grow_step, max_sparsity-freqs.shape[1])
+            for c in np.argsort(-scores)[:step]:
+                b, phi = B[:, cols[c]], cand_Phi[:, cols[c]]
+                u, v_H = inv_A.dot(b), b.conj().T.dot(inv_A)
+                # Schur complement against the bases added earlier this step
+                inv_s = linalg.inv(phi.conj().T.dot(phi)+noise*eye-v_H.dot(b))
+                inv_A = np.block([[inv_A+u.dot(inv_s).dot(v_H), -u.dot(inv_s)],
+                    [-inv_s.dot(v_H), inv_s]])
+                # Refresh the borders of all candidates left in this step
+                B = np.vstack((B, phi.conj().T.dot(cand_Phi)))
+                Phi = np.hstack((Phi, phi))
+                Phi_valid = np.hstack((Phi_valid, cand_Phi_valid[:, cols[c]]))
+                PhiHy = np.vstack((PhiHy, phi.conj().T.dot(y_train)))
+                freqs = np.hstack((freqs, cand_freqs[:, c][:, None]))
+            alpha = inv_A.dot(PhiHy)
+            cost = get_valid_cost(alpha)
+            self.telemetry.emit({'sparsity':freqs.shape[1],
+                'valid_cost':float(cost)}, "  grow M=%d - valid %.8f"%(
+                freqs.shape[1], cost))
+            if(cost < best_cost):
+                best_cost, best_M, stall = cost, freqs.shape[1], 0
+            else:
+                stall += 1
+        self.M = best_M
+        self.kernel_scale = Phi_const**2*self.M
+        self.spectral_freqs = freqs[:, :best_M]
+        self.train()
+        return self
+
+    def prune(self, max_error=None, target_M=None, X=None, time_reps=3):
+        # Remove basis functions by least saliency |alpha_m|^2/inv(A)_mm (the
+        # data fit increase), downdating inv(A) instead of retraining
+        assert not self.freqs_lattice, "Lattice frequencies cannot be pruned!"
+        assert not self.fastfood, "Fastfood frequencies cannot be pruned!"
+        assert max_error is not None or target_M is not None,\
+            "Either max_error or target_M is required!"
+        from timeit import Timer
+        X_eval, scaled = (self.X, False) if X is None else (X, True)
+        time_predict = lambda:Timer(lambda:self.predict(
+            X_eval, scaled)).timeit(time_reps)/time_reps
+        time_before, M_before = time_predict(), self.M
+        Phi_const = np.sqrt(self.kernel_scale/self.M)
+        # Real-output models hold a [cos, sin] column pair per basis, inv(A)
+        # is laid out [cos..., sin...] and alpha as [Re; Im]
+        real = self.real_output
+        get_Phi = lambda Phi:self.get_real_features(Phi) if real else Phi
+        get_cols = lambda index, n:index+[n+i for i in index] if real else index
+        if(self.inv_A is None):
+            Phi = get_Phi(Phi_const*np.exp(-2j*np.pi*self.project(self.X)))
+            noise = self.noise_real if real else\
+                self.noise_real+self.noise_imag*1j
+            A = Phi.conj().T.dot(Phi)+noise*np.eye(Phi.shape[1])
+            inv_A = linalg.inv(A)
+        else:
+            inv_A = self.inv_A
+            A = linalg.inv(inv_A)
+        alpha = np.vstack((self.alpha.real, self.alpha.imag)) if real else\
+            self.alpha
+        PhiHy = A.dot(alpha)
+        # Same inputs as predict sees: CSR rows stay unscaled for project
+        if(X is None):
+            X_scaled = self.X
+        elif(sparse.issparse(X)):
+            X_scaled = sparse.csr_matrix(X, dtype=np.float64)
+        else:
+            X_scaled = self.X_scaler.eval(np.array(X))
+        Phi_eval = get_Phi(Phi_const*np.exp(-2j*np.pi*self.project(X_scaled)))
+        mu_eval = Phi_eval.dot(alpha)
+        keep = list(range(self.M))
+        target_M = 1 if target_M is None else target_M
+        error = 0.
+        # Pairwise frequency distances once from the Gram matrix, rows and
+        # columns of removed bases are dropped along the way
+        freqs_sq = np.sum(self.spectral_freqs**2, 0)
+        dists = np.sqrt(np.maximum(freqs_sq[:, None]+freqs_sq[None, :]-
+            2*self.spectral_freqs.T.dot(self.spectral_freqs), 0))
+        dists[np.diag_indices(self.M)] = np.Infinity
+        while(len(keep) > target_M):
+            n = len(keep)
+            # Nearly coincident frequencies are merged by dropping one of them
+            if(np.min(dists) < self.prune_merge_tol):
+                m = np.unravel_index(np.argmin(dists), dists.shape)[1]
+            elif(real):
+                # alpha_m^T inv(inv(A)_mm) alpha_m with 2 x 2 blocks
+                a, b = alpha[:n, 0], alpha[n:, 0]
+                p, q = np.diagonal(inv_A)[:n], np.diagonal(inv_A, n)
+                r = np.diagonal(inv_A)[n:]
+                m = np.argmin((r*a**2-2*q*a*b+p*b**2)/(p*r-q**2))
+            else:
+                saliency = np.absolute(alpha.ravel())**2/\
+                    np.absolute(np.diagonal(inv_A))
+                m = np.argmin(saliency)
+            rest = [i for i in range(n) if i != m]
+            R, rest_cols = get_cols([m], n), get_cols(rest, n)
+            new_inv_A = inv_A[np.ix_(rest_cols, rest_cols)]-inv_A[np.ix_(
+                rest_cols, R)].dot(linalg.inv(inv_A[np.ix_(R, R)])).dot(
+                inv_A[np.ix_(R, rest_cols)])
+            new_keep = [keep[i] for i in rest]
+            new_cols = get_cols(new_keep, M_before)
+            new_alpha = new_inv_A.dot(PhiHy[new_cols])
+            new_error = Metric('mse').eval(
+                mu_eval, Phi_eval[:, new_cols].dot(new_alpha), None)
+            if(max_error is not None and new_error > max_error):
+                break
+            keep, inv_A, alpha, error = new_keep, new_inv_A, new_alpha, new_error
+            dists = dists[np.ix_(rest, rest)]
+        cols = get_cols(keep, M_before)
+        self.spectral_freqs = self.spectral_freqs[:, keep]
+        self.kernel_scale = Phi_const**2*len(keep)
+        self.M = len(keep)
+        self.alpha = alpha[:self.M]+1j*alpha[self.M:] if real else alpha
+        self.inv_A = None if self.mean_only else inv_A
+        self.train_Phi, self.inv_K = None, None
+        if(real):
+            self.T = linalg.cho_factor(A[np.ix_(cols, cols)], lower=True)
+            self.log_det_A = 2*np.sum(np.log(np.diagonal(self.T[0])))
+        else:
+            self.T = linalg.schur(A[np.ix_(cols, cols)], 'complex')[0]
+            self.log_det_A = np.sum(np.log(np.diagonal(self.T)))
+        time_after = time_predict()
+        return {'M_before':M_before, 'M_after':self.M, 'error':error,
+            'speedup':time_before/time_after}
+
+    def get_linear_fit_noise_init(self):
+        # Residual of a least-squares linear fit sizes the noise, the rest of
+        # the target variance goes to the kernel scale
+        X = np.hstack((np.real(self.X), np.ones((self.X.shape[0], 1))))
+        residual = self.y-X.dot(linalg.lstsq(X, self.y)[0])
+        noise_real = max(np.var(residual.real), 1e-6)
+        noise_imag = max(np.var(residual.imag), 1e-6)
+        kernel_scale = max(np.var(self.y.real)+np.var(self.y.imag)-
+            noise_real-noise_imag, 1e-2)
+        return np.log([noise_real, noise_imag, kernel_scale])
+    
+    def get_periodogram_freqs_init(self):
+        # Spectral peaks of the scaled targets binned along random projections
+        n_proj = max(self.M//4, 1)
+        peaks_per_proj = int(np.ceil(self.M/n_proj))
+        bins = self.periodogram_bins
+        freqs = []
+        for _ in range(n_proj):
+            u = npr.randn(self.D)
+            u /= np.linalg.norm(u)
+            t = np.real(self.X).dot(u)
+            t_min, t_max = np.min(t), np.max(t)+1e-8
+            bin_ind = ((t-t_min)/(t_max-t_min)*bins).astype(int)
+            counts = np.bincount(bin_ind, minlength=bins)
+            sums = np.bincount(bin_ind, self.y.real.ravel(), bins)+\
+                1j*np.bincount(bin_ind, self.y.imag.ravel(), bins)
+            power = np.absolute(np.fft.fft(sums/np.maximum(counts, 1)))**2
+            power[0] = 0
+            fft_freqs = np.fft.fftfreq(bins, (t_max-t_min)/bins)
+            # A component exp(2j*pi*f*t) shows at +f, the basis is exp(-2j*pi*w*x)
+            for k in np.argsort(-power)[:peaks_per_proj]:
+                freqs.append(-fft_freqs[k]*u)
+        freqs = np.array(freqs[:self.M]).T
+        return freqs+npr.randn(*freqs.shape)*1e-2
+    
+    def get_qmc_freqs_init(self, engine):
+        try:
+            from scipy.stats import qmc, norm
+        except ImportError:
+            raise ImportError("Quasi-random initialization needs scipy>=1.7!")
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            uniform = getattr(qmc, engine)(d=self.D, scramble=True).random(self.M)
+        return norm.ppf(np.clip(uniform, 1e-12, 1-1e-12)).T
+    
+    def get_sobol_freqs_init(self):
+        return self.get_qmc_freqs_init('Sobol')
+    
+    def get_halton_freqs_init(self):
+        return self.get_qmc_freqs_init('Halton')
+
+    def get_hyperparams_size(self):
+        if(self.freqs_lattice):
+            return 4
+        if(self.fastfood):
+            return 3+self.fastfood_op.M_pad+self.M
+        return 3+self.D*self.M
+
     def get_hyperparams(self):
-        hyperparams = np.zeros(3+self.D*self.M)
+        hyperparams = np.zeros(self.get_hyperparams_size())
         hyperparams[0] = np.log(self.noise_real.real)
         hyperparams[1] = np.log(self.noise_imag.real)
         hyperparams[2] = np.log(self.kernel_scale.real)
-        hyperparams[3:] = np.reshape(self.spectral_freqs.real, (self.D*self.M,))
+        if(self.freqs_lattice):
+            hyperparams[3] = np.log(self.lattice_scale)
+        elif(self.fastfood):
+            hyperparams[3:] = np.concatenate(
+                [self.fastfood_op.G, self.fastfood_op.S])
+        else:
+            hyperparams[3:] = np.reshape(
+                self.spectral_freqs.real, (self.D*self.M,))
         return hyperparams
 
     def set_hyperparams(self, hyperparams):
         self.noise_real = np.exp(hyperparams[0])
         self.noise_imag = np.exp(hyperparams[1])
         self.kernel_scale = np.exp(hyperparams[2])
-        self.spectral_freqs = np.reshape(hyperparams[3:], (self.D, self.M))
+        if(self.freqs_lattice):
+            self.set_lattice_scale(np.exp(hyperparams[3]))
+        elif(self.fastfood):
+            M_pad = self.fastfood_op.M_pad
+            self.set_fastfood_diagonals(
+                hyperparams[3:3+M_pad], hyperparams[3+M_pad:])
+        else:
+            self.spectral_freqs = np.reshape(hyperparams[3:], (self.D, self.M))
         self.train()
     
+    def set_fastfood_diagonals(self, G, S):
+        # Dense frequencies are materialized in O(D M log D) as a cache for
+        # the state key, prediction and all code written against W
+        self.fastfood_op.set_diagonals(np.array(G), np.array(S))
+        self.spectral_freqs = self.fastfood_op.to_dense()
+    
+    def set_lattice_scale(self, lattice_scale):
+        assert self.D == 1, "Frequency lattice only supports 1-D inputs!"
+        self.lattice_scale = lattice_scale
+        k = -(self.M//2)+np.arange(self.M)
+        self.spectral_freqs = self.lattice_scale*k[None, :]
+    
+    def get_lattice_points(self, X):
+        # exp(-2j*pi*x*k) has period 1 in x for integer k, so wrap into NFFT range
+        return (np.real(X[:, 0])*self.lattice_scale+.5)%1-.5
+    
+    def lattice_nfft(self, X, f_hat):
+        M_even = self.M+self.M%2
+        f_hat = np.concatenate([np.zeros(M_even-self.M), f_hat])
+        return nfft(self.get_lattice_points(X), f_hat, M_even)
+    
+    def lattice_adj_nfft(self, X, f):
+        M_even = self.M+self.M%2
+        return adj_nfft(self.get_lattice_points(X), f, M_even)[M_even-self.M:]
+    
+    def project(self, X, freqs=None):
+        # Scaled X times the frequencies, implicitly scaled for CSR inputs:
+        # (x-min)/range-.5 on W is x.(W/range) with a constant phase bias
+        if(freqs is None and self.fastfood and not sparse.issparse(X) and
+            self.D*self.M > self.fastfood_gemm_ratio*2*
+                self.fastfood_op.M_pad*np.log2(self.fastfood_op.D_pad)):
+            # Hadamard transforms only beat BLAS on the dense W when D is big
+            return self.fastfood_op.matvec(X)
+        freqs = self.spectral_freqs if freqs is None else freqs
+        if(not sparse.issparse(X)):
+            return X.dot(freqs)
+        x_range = self.X_scaler._r_max_-self.X_scaler._r_min_
+        return np.asarray(X.dot(freqs/x_range[:, None]))-\
+            (self.X_scaler._r_min_/x_range+.5).dot(freqs)
+
+    def set_data(self, X, y, fold=None, weights=None):
+        # Data key tells memoized factorizations of different folds apart
+        self.X, self.y, self.row_weights = X, y, weights
+        self.data_key = (self.data_version, self.fidelity, fold)
+    
+    def set_fidelity(self, fidelity, subsample_index=None):
+        # Cheap early costs on a random subset of rows, full data at fidelity 1
+        full_N = self.full_X.shape[0]
+        if(fidelity >= 1 or int(full_N*fidelity) >= full_N):
+            self.fidelity, self.subsample_index = 1., None
+            return self.set_data(self.full_X, self.full_y, None,
+                self.full_weights)
+        if(subsample_index is None):
+            subsample_index = np.sort(npr.choice(
+                full_N, max(int(full_N*fidelity), 2), replace=False))
+        self.fidelity, self.subsample_index = fidelity, subsample_index
+        self.set_data(self.full_X[subsample_index],
+            self.full_y[subsample_index], None, None if self.full_weights
+            is None else self.full_weights[subsample_index])
+
+    def get_data_cost(self, X, y, weights=None):
+        self.data_version += 1
+        self.set_data(X, y, None, weights)
+        return self.get_cost()
+
+    def get_coreset_error(self, full_X, full_y):
+        # Coreset and full data costs at the current hyperparameters, the full
+        # rows get their own data key so both stay memoized side by side
+        fidelity, subsample_index = self.fidelity, self.subsample_index
+        self.set_fidelity(1.)
+        cost = self.get_cost()
+        self.set_data(full_X, full_y, 'full')
+        full_cost = self.get_cost()
+        self.set_fidelity(fidelity, subsample_index)
+        return cost, full_cost, np.absolute(cost-full_cost)/np.absolute(full_cost)
+
+    def set_coreset(self, coreset, size, full_X, full_y):
+        # Hyperparameters are searched on a weighted subset of rows, which is
+        # doubled until its cost is within coreset.tol of the full data cost;
+        # from half of the rows on sampling saves nothing over all of them
+        fidelity, N = self.fidelity, full_X.shape[0]
+        max_size = min(coreset.max_size or N, N)
+        size = min(size, max_size)
+        self.set_fidelity(1.)
+        while(True):
+            self.set_data(full_X, full_y, 'full')
+            if(size >= N//2 and max_size == N):
+                size, X, y, weights = N, full_X, full_y, None
+            else:
+                with self.telemetry.phase('coreset'):
+                    X, y, weights = coreset.sample(self, size)
+            self.full_X, self.full_y, self.full_weights = X, y, weights
+            self.data_version += 1
+            cost, full_cost, error = self.get_coreset_error(full_X, full_y)
+            if(error <= coreset.tol or size >= max_size):
+                break
+            size = min(size*2, max_size)
+        self.set_fidelity(fidelity)
+        report = self.coreset_report or {'init_cost':cost,
+            'init_full_cost':full_cost, 'init_error':error, 'resamples':-1}
+        report.update({
+            'method':coreset.method,
+            'size':X.shape[0],
+            'sample_size':size,
+            'max_size':max_size,
+            'N':N,
+            'resamples':report['resamples']+1,
+            'errors':[error],
+        })
+        self.coreset_report = report
+
+    def check_coreset(self, coreset, full_X, full_y):
+        # True when the search has drifted off and a larger coreset can help
+        report = self.coreset_report
+        cost, full_cost, error = self.get_coreset_error(full_X, full_y)
+        report['errors'].append(error)
+        report.update({'final_cost':cost, 'final_full_cost':full_cost,
+            'final_error':error, 'max_error':max(report['errors'])})
+        return error > coreset.tol and report['sample_size'] < report['max_size']
+
+    def refine_coreset(self, coreset, trainer, full_X, full_y):
+        # The bound is enforced at the learned hyperparameters: on a drift the
+        # search resumes there on a doubled coreset with the remaining budget,
+        # as it does when a periodic check has already stopped it
+        if(not trainer.stopped and
+            not self.check_coreset(coreset, full_X, full_y)):
+            return False
+        self.set_coreset(coreset, 2*self.coreset_report['sample_size'],
+            full_X, full_y)
+        trainer.max_iter -= trainer.iter
+        if(trainer.time_budget is not None):
+            trainer.time_budget -= time.time()-trainer.start_time
+        return True
+
+    def unset_coreset(self, coreset, full_X, full_y):
+        report = self.coreset_report
+        self.full_X, self.full_y, self.full_weights = full_X, full_y, None
+        self.data_version += 1
+        self.set_fidelity(1.)
+        report['max_error'] = max(report['errors'])
+        self.telemetry.emit(dict(report), "  coreset %d/%d rows - cost "
+            "discrepancy %.4f"%(report['size'], report['N'],
+            report['max_error']))
+        if(report['max_error'] > coreset.tol):
+            warnings.warn("Coreset cost discrepancy %.4f exceeds tol %.4f at "
+                "%d/%d rows!"%(report['max_error'], coreset.tol,
+                report['size'], report['N']))
+    
+    def clear_cache(self):
+        self.train_cache, self.cost_cache = OrderedDict(), OrderedDict()
+        self.duplicates_cache = OrderedDict()
+        self.cache_stats = {'train_hits':0, 'train_misses':0,
+            'cost_hits':0, 'cost_misses':0,
+            'duplicates_hits':0, 'duplicates_misses':0}
+    
+    def get_state_key(self):
+        state = hashlib.sha1(np.array([self.noise_real, self.noise_imag,
+            self.kernel_scale], dtype=np.complex128).tobytes())
+        state.update(np.ascontiguousarray(self.spectral_freqs).tobytes())
+        return (state.hexdigest(), self.data_key, self.mean_only)
+    
+    def cache_lookup(self, cache, key, name):
+        if(key in cache):
+            cache.move_to_end(key)
+            self.cache_stats[name+'_hits'] += 1
+            self.telemetry.count(name+'_cache_hits')
+            return cache[key]
+        self.cache_stats[name+'_misses'] += 1
+        return None
+    
+    def get_nbytes(self, value):
+        if(isinstance(value, (list, tuple))):
+            return sum(self.get_nbytes(item) for item in value)
+        return getattr(value, 'nbytes', 0)
+
+    def cache_store(self, cache, key, value):
+        # Entries hold M x M factorizations, so the cache is bounded by bytes
+        # as well as by count, the newest entry is always kept
+        cache[key] = value
+        while(len(cache) > 1 and (len(cache) > self.cache_size or sum(
+            map(self.get_nbytes, cache.values())) > self.cache_bytes)):
+            cache.popitem(last=False)
+    
+    def get_duplicate_groups(self):
+        # Identical rows of X give identical rows of Phi: rows are hashed by
+        # their bytes and every group enters the solve once, scaled by the
+        # square root of its count, with its summed targets
+        groups = self.cache_lookup(self.duplicates_cache, self.data_key,
+            'duplicates')
+        if(groups is not None):
+            return groups
+        X, y = np.ascontiguousarray(self.X), self.y
+        rows = X.view(np.dtype((np.void, X.dtype.itemsize*X.shape[1])))
+        _, index, inverse, counts = np.unique(rows.ravel(), return_index=True,
+            return_inverse=True, return_counts=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.cumsum(counts)-counts
+        if(self.row_weights is not None):
+            y = y*self.row_weights[:, None]
+            counts = np.add.reduceat(self.row_weights[order], starts)
+        y_sums = np.add.reduceat(y[order], starts)
+        weights = np.sqrt(counts)
+        groups = (X[index], y_sums/weights[:, None], weights, inverse.ravel())
+        self.cache_store(self.duplicates_cache, self.data_key, groups)
+        return groups
+
+    def get_train_data(self):
+        if(self.aggregate_duplicates):
+            return self.get_duplicate_groups()[:3]
+        if(self.row_weights is None):
+            return self.X, self.y, None
+        weights = np.sqrt(self.row_weights)
+        return self.X, self.y*weights[:, None], weights
+
     def train(self, nfft=False):
-        self.N = self.X.shape[0]
-        X_sparse = self.X.dot(self.spectral_freqs)
+        key = self.get_state_key()
+        trained = self.cache_lookup(self.train_cache, key, 'train')
+        if(trained is not None):
+            for attr, value in zip(self.trained_attrs, trained):
+                setattr(self, attr, value)
+            return
+        self.N = self.X.shape[0] if self.row_weights is None else\
+            np.sum(self.row_weights)
+        self.telemetry.count('train_calls')
+        self.train_Phi, self.inv_K = None, None
+        if(self.freqs_lattice):
+            self.train_lattice()
+        elif(self.real_output):
+            self.train_real()
+        elif(self.get_train_data()[0].shape[0] < self.M):
+            self.train_dual()
+        else:
+            self.train_primal()
+        self.cache_store(self.train_cache, key,
+            [getattr(self, attr) for attr in self.trained_attrs])
+    
+    def train_primal(self):
+        X, y, weights = self.get_train_data()
+        with self.telemetry.phase('build_Phi'):
+            Phi_const = np.sqrt(self.kernel_scale/self.M)
+            noise = self.noise_real+self.noise_imag*1j
+            A, PhiHy = blocked_gram(X, self.project, y, self.M, Phi_const,
+                False, self.gram_tile_size, self.gram_threads, weights)
+            A[np.diag_indices(self.M)] += noise
+        with self.telemetry.phase('factorize'):
+            self.T, Q = linalg.schur(A, 'complex')
+            if(self.mean_only):
+                self.inv_A = None
+                self.alpha = Q.conj().T.dot(PhiHy)
+                self.alpha = Q.dot(linalg.solve_triangular(self.T, self.alpha))
+            else:
+                self.inv_A = Q.dot(linalg.solve_triangular(self.T, Q.conj().T))
+                self.alpha = self.inv_A.dot(PhiHy)
+            self.log_det_A = np.sum(np.log(np.diagonal(self.T)))
+    
+    def train_dual(self):
+        # Woodbury: with N < M, alpha = Phi^H (Phi Phi^H + noise I)^{-1} y and
+        # inv(A) = (I - Phi^H inv(K) Phi)/noise, so only N x N is factorized
+        X, y, weights = self.get_train_data()
+        N = X.shape[0]
+        with self.telemetry.phase('build_Phi'):
+            X_sparse = self.project(X)
+            Phi_const = np.sqrt(self.kernel_scale/self.M)
+            Phi = Phi_const*np.exp(-2j*np.pi*X_sparse)
+            if(weights is not None):
+                Phi *= weights[:, None]
+            noise = self.noise_real+self.noise_imag*1j
+            K = Phi.dot(Phi.conj().T)+noise*np.eye(N)
+        with self.telemetry.phase('factorize'):
+            self.T, Q = linalg.schur(K, 'complex')
+            self.inv_A = None
+            if(self.mean_only):
+                inv_K_y = Q.dot(linalg.solve_triangular(
+                    self.T, Q.conj().T.dot(y)))
+            else:
+                self.train_Phi = Phi
+                self.inv_K = Q.dot(linalg.solve_triangular(self.T, Q.conj().T))
+                inv_K_y = self.inv_K.dot(y)
+            self.alpha = Phi.conj().T.dot(inv_K_y)
+            # det(A) = noise^(M-N) det(K) by Sylvester's determinant identity
+            self.log_det_A = np.sum(np.log(np.diagonal(self.T)))+\
+                (self.M-N)*np.log(noise)
+    
+    def get_real_features(self, Phi):
+        # Real targets only need Re(Phi alpha): [cos, sin] features carry
+        # the same kernel, alpha is kept as a + ib so that mu = Re(Phi alpha)
+        return np.hstack((Phi.real, -Phi.imag))
+
+    def train_real(self):
+        # Real Gram matrix of size 2M (or N) and a real Cholesky instead of
+        # the complex Schur form
+        X, y, weights = self.get_train_data()
+        N, y = X.shape[0], np.real(y)
         Phi_const = np.sqrt(self.kernel_scale/self.M)
-        Phi = Phi_const*np.exp(-2j*np.pi*X_sparse)
-        noise = self.noise_real+self.noise_imag*1j
-        A = Phi.conj().T.dot(Phi)+noise*np.eye(self.M)
-        self.T, Q = linalg.schur(A, 'complex')
-        PhiHy = Phi.conj().T.dot(self.y)
-        if(self.mean_only):
+        noise = self.noise_real
+        with self.telemetry.phase('build_Phi'):
+            if(N < 2*self.M):
+                Phi = self.get_real_features(
+                    Phi_const*np.exp(-2j*np.pi*self.project(X)))
+                if(weights is not None):
+                    Phi *= weights[:, None]
+            else:
+                A, PhiTy = blocked_gram(X, self.project, y, self.M, Phi_const,
+                    True, self.gram_tile_size, self.gram_threads, weights)
+                A[np.diag_indices(2*self.M)] += noise
+        with self.telemetry.phase('factorize'):
+            if(N < 2*self.M):
+                K = Phi.dot(Phi.T)+noise*np.eye(N)
+                self.T = linalg.cho_factor(K, lower=True)
+                alpha = Phi.T.dot(linalg.cho_solve(self.T, y))
+                self.inv_A = None if self.mean_only else (np.eye(2*self.M)-
+                    Phi.T.dot(linalg.cho_solve(self.T, Phi)))/noise
+                self.log_det_A = 2*np.sum(np.log(np.diagonal(self.T[0])))+\
+                    (2*self.M-N)*np.log(noise)
+            else:
+                self.T = linalg.cho_factor(A, lower=True)
+                alpha = linalg.cho_solve(self.T, PhiTy)
+                self.inv_A = None if self.mean_only else\
+                    linalg.cho_solve(self.T, np.eye(2*self.M))
+                self.log_det_A = 2*np.sum(np.log(np.diagonal(self.T[0])))
+            self.alpha = alpha[:self.M]+1j*alpha[self.M:]
+
+    def train_lattice(self):
+        # Gram matrix of lattice frequencies is Toeplitz: one adjoint NFFT of
+        # ones gives its first column, the rest is O(M log M) by FFT
+        with self.telemetry.phase('build_Phi'):
+            x = self.get_lattice_points(self.X)
+            Phi_const = np.sqrt(self.kernel_scale/self.M)
+            noise = self.noise_real+self.noise_imag*1j
+            gram_col = Phi_const**2*adj_nfft(x, np.ones(self.N)+0j, 2*self.M)
+            col = gram_col[self.M:].copy()
+            row = col.conj()
+            col[0] += noise
+            row[0] = col[0]
+            self.T = ToeplitzOperator(col, row)
+            PhiHy = Phi_const*self.lattice_adj_nfft(self.X, self.y.ravel()+0j)
+        with self.telemetry.phase('factorize'):
             self.inv_A = None
-            self.alpha = Q.conj().T.dot(PhiHy)
-            self.alpha = Q.dot(linalg.solve_triangular(self.T, self.alpha))
-        else:
-            self.inv_A = Q.dot(linalg.solve_triangular(self.T, Q.conj().T))
-            self.alpha = self.inv_A.dot(PhiHy)
+            self.alpha = self.T.solve(PhiHy)[:, None]
+            # Szego-type approximation of log|A| by its circulant preconditioner
+            self.log_det_A = np.sum(np.log(
+                self.T.get_circulant_preconditioner().eigs))
     
     def get_cost(self):
-        return self.get_cv_metric(self.cv_folds, self.cost_type)
+        key = self.get_state_key()+(self.cost_type, self.cv_folds)
+        cost = self.cache_lookup(self.cost_cache, key, 'cost')
+        if(cost is not None):
+            self.train()
+            return cost
+        cost = self.get_cv_metric(self.cv_folds, self.cost_type)
+        self.cache_store(self.cost_cache, key, cost)
+        return cost
 
     def get_cv_metric(self, n_folds, metric, scaled=False):
         cv_metric = Metric(metric, self)
+        return_std = metric not in cv_metric.std_free_metrics
         cv_results = []
-        data = np.hstack((self.X.copy(), self.y.copy()))
+        # Folds are row indices, so dense and CSR inputs are split alike
+        X, y, weights = self.X, self.y, self.row_weights
+        data_key = self.data_key
+        N = X.shape[0]
+        fold_weights = lambda index:None if weights is None else weights[index]
         if(n_folds > 1):
-            fold_size = self.N//n_folds
-            for i in range(n_folds):
-                st_ind, ed_ind = fold_size*i, min(fold_size*(i+1), data.shape[0])
-                cv_X = data[st_ind:ed_ind, :-1]
-                cv_y = data[st_ind:ed_ind, -1][:, None]
-                if(scaled):
-                    cv_y = self.y_scaler.eval(cv_y, inv=True)
-                self.X = np.vstack((data[:st_ind, :-1], data[ed_ind:, :-1]))
-                self.y = np.hstack((data[:st_ind, -1], data[ed_ind:, -1]))[:, None]
+            with self.telemetry.phase('cv_folds'):
+                fold_size = N//n_folds
+                for i in range(n_folds):
+                    st_ind = fold_size*i
+                    ed_ind = min(fold_size*(i+1), N)
+                    cv_X, cv_y = X[st_ind:ed_ind], y[st_ind:ed_ind]
+                    if(scaled):
+                        cv_y = self.y_scaler.eval(cv_y, inv=True)
+                    train_index = np.concatenate(
+                        (np.arange(st_ind), np.arange(ed_ind, N)))
+                    # Fold keys extend the caller's key, so folds of the
+                    # coreset and of the full data never share factorizations
+                    self.set_data(X[train_index], y[train_index],
+                        (data_key, i, n_folds), fold_weights(train_index))
+                    self.train()
+                    cv_metric.weights = fold_weights(slice(st_ind, ed_ind))
+                    cv_results.append(self.N*cv_metric.eval(
+                        cv_y, *self.predict(cv_X, scaled, return_std)))
+                self.X, self.y, self.row_weights = X, y, weights
+                self.data_key = data_key
                 self.train()
-                cv_results.append(self.N*cv_metric.eval(
-                    cv_y, *self.predict(cv_X, scaled=scaled)))
-            self.X, self.y = data[:, :-1], data[:, -1][:, None]
-            self.train()
         else:
             self.train()
+            cv_metric.weights = weights
             if(scaled):
                 cv_y = self.y_scaler.eval(self.y, inv=True)
             else:
                 cv_y = self.y
-            cv_results = [self.N*cv_metric.eval(
-                cv_y, *self.predict(self.X, scaled=scaled))]
-        return np.sum(cv_results)/data.shape[0]
+            if(self.aggregate_duplicates):
+                # Predict each group once and expand, the metric still sees
+                # every row so the cost is unchanged by the aggregation
+                X_unique, _, _, inverse = self.get_duplicate_groups()
+                mu, std = self.predict(X_unique, scaled, return_std)
+                mu, std = mu[inverse], std[inverse]
+            else:
+                mu, std = self.predict(self.X, scaled, return_std)
+            cv_results = [self.N*cv_metric.eval(cv_y, mu, std)]
+        return np.sum(cv_results)/(N if weights is None else np.sum(weights))
 
     def get_cost_grad(self):
-        self.cur_cost = self.get_cost()
-        self.noise_real -= self.grad_epsilon
-        self.train()
-        self.last_cost = self.get_cost()
-        d_cost_d_noise = self.get_d_cost_d_noise()
-        g11 = self.noise_real*d_cost_d_noise[0]
-        g12 = self.noise_imag*d_cost_d_noise[1]
-        d_cost_d_kernel_scale = self.get_d_cost_d_kernel_scale()
-        g2 = self.kernel_scale*d_cost_d_kernel_scale.real
-        d_cost_d_freqs = self.get_d_cost_d_freqs()
-        g3 = np.reshape(d_cost_d_freqs.real, (self.D*self.M,))
-        self.noise_real += self.grad_epsilon
+        with self.telemetry.phase('grad_probes'):
+            self.cur_cost = self.get_cost()
+            self.noise_real -= self.grad_epsilon
+            self.train()
+            self.last_cost = self.get_cost()
+            d_cost_d_noise = self.get_d_cost_d_noise()
+            g11 = self.noise_real*d_cost_d_noise[0]
+            g12 = self.noise_imag*d_cost_d_noise[1]
+            d_cost_d_kernel_scale = self.get_d_cost_d_kernel_scale()
+            g2 = self.kernel_scale*d_cost_d_kernel_scale.real
+            if(self.freqs_lattice):
+                g3 = [self.lattice_scale*self.get_d_cost_d_lattice_scale()]
+            elif(self.fastfood):
+                g3 = self.get_d_cost_d_fastfood_diagonals()
+            elif(self.grad_estimator != 'coordinate'):
+                d_cost_d_freqs = self.get_d_cost_d_freqs_by_directions()
+                g3 = np.reshape(d_cost_d_freqs.real, (self.D*self.M,))
+            else:
+                d_cost_d_freqs = self.get_d_cost_d_freqs()
+                g3 = np.reshape(d_cost_d_freqs.real, (self.D*self.M,))
+            self.noise_real += self.grad_epsilon
         return np.concatenate([[g11, g12, g2], g3])
     
     def get_d_cost_d_noise(self):
@@ -179,6 +1143,14 @@ class GomPlex(object):
         self.kernel_scale -= self.grad_epsilon
         return (cost_plus-self.last_cost)/(self.grad_epsilon*2)
     
+    def get_d_cost_d_lattice_scale(self):
+        # Warning: numerical gradient is used just for testing the idea
+        self.set_lattice_scale(self.lattice_scale+self.grad_epsilon)
+        self.train()
+        cost_plus = self.get_cost()
+        self.set_lattice_scale(self.lattice_scale-self.grad_epsilon)
+        return (cost_plus-self.last_cost)/(self.grad_epsilon*2)
+    
     def get_d_cost_d_freqs(self):
         # Warning: numerical gradient is used just for testing the idea
         d_cost_d_freqs = np.zeros_like(self.spectral_freqs)
@@ -194,10 +1166,50 @@ class GomPlex(object):
                     (self.grad_epsilon*2)
         return d_cost_d_freqs
 
+    def get_d_cost_d_fastfood_diagonals(self):
+        # Warning: numerical gradient is used just for testing the idea
+        G, S = self.fastfood_op.G.copy(), self.fastfood_op.S.copy()
+        diagonals = np.concatenate([G, S])
+        d_cost_d_diagonals = np.zeros_like(diagonals)
+        update_num = max(int(len(diagonals)*self.freqs_update_rate), 1)
+        for i in npr.choice(len(diagonals), update_num, replace=False):
+            diagonals[i] += self.grad_epsilon
+            self.set_fastfood_diagonals(diagonals[:len(G)], diagonals[len(G):])
+            self.train()
+            cost_plus = self.get_cost()
+            diagonals[i] -= self.grad_epsilon
+            d_cost_d_diagonals[i] = (cost_plus-self.last_cost)/\
+                (self.grad_epsilon*2)
+        self.set_fastfood_diagonals(G, S)
+        return d_cost_d_diagonals
+
+    def get_d_cost_d_freqs_by_directions(self):
+        # Two cost evaluations per direction estimate all D*M derivatives:
+        # Rademacher directions give SPSA, Gaussian ones a random-direction
+        # estimator, both unbiased as E[delta delta^T] = I
+        spectral_freqs = self.spectral_freqs
+        d_cost_d_freqs = np.zeros_like(spectral_freqs)
+        for _ in range(self.grad_directions):
+            if(self.grad_estimator == 'spsa'):
+                delta = npr.choice([-1., 1.], spectral_freqs.shape)
+            else:
+                delta = npr.randn(*spectral_freqs.shape)
+            self.spectral_freqs = spectral_freqs+self.spsa_epsilon*delta
+            self.train()
+            cost_plus = self.get_cost()
+            self.spectral_freqs = spectral_freqs-self.spsa_epsilon*delta
+            self.train()
+            cost_minus = self.get_cost()
+            d_cost_d_freqs += delta*(cost_plus-cost_minus)/(self.spsa_epsilon*2)
+        self.spectral_freqs = spectral_freqs
+        return d_cost_d_freqs/self.grad_directions
+
     def save(self, path):
         save_pack = [self.noise_imag, self.noise_real, self.kernel_scale,
             self.spectral_freqs, self.X_scaler, self.y_scaler, self.T,
-            self.inv_A, self.alpha, self.N, self.hashed_name, self.mean_only]
+            self.inv_A, self.alpha, self.N, self.hashed_name, self.mean_only,
+            self.freqs_lattice, self.train_Phi, self.inv_K, self.fastfood,
+            self.fastfood_op, self.real_output]
         import pickle
         with open(path, "wb") as save_f:
             pickle.dump(save_pack, save_f, pickle.HIGHEST_PROTOCOL)
@@ -218,8 +1230,19 @@ class GomPlex(object):
             self.alpha = load_pack[i];i+=1
             self.N = load_pack[i];i+=1
             self.hashed_name = load_pack[i];i+=1
-            self.mean_only = load_pack[i]
+            self.mean_only = load_pack[i];i+=1
+            self.freqs_lattice = load_pack[i] if i < len(load_pack) else False
+            i+=1
+            if(i < len(load_pack)):
+                self.train_Phi = load_pack[i];i+=1
+                self.inv_K = load_pack[i];i+=1
+            if(i < len(load_pack)):
+                self.fastfood = load_pack[i];i+=1
+                self.fastfood_op = load_pack[i];i+=1
+                self.real_output = load_pack[i];i+=1
             self.D, self.M = self.spectral_freqs.shape
+            if(self.freqs_lattice):
+                self.lattice_scale = self.spectral_freqs[0, self.M//2+1]
         return self
     
     
@@ -0,0 +1,222 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+import time
+import numpy as np
+import numpy.random as npr
+
+from .. import Scaler, Optimizer, Telemetry
+from .GomPlex import GomPlex
+
+class GomPlexBatch(object):
+
+    # Many GomPlex models on the same data trained in lock-step: frequencies
+    # are stacked (zero padded to the largest sparsity), all Phi blocks come
+    # from one GEMM and all A matrices from one batched eigendecomposition
+    
+    grad_epsilon = 1e-8
+    cost_types = ['nlml', 'mse', 'rmse', 'nmse']
+    optimizers = ['adaptive', 'adam']
+
+    def __init__(self, sparsities, mean_only=False, seeds=None):
+        self.sparsities = np.array(sparsities, dtype=int)
+        self.B, self.M = len(self.sparsities), np.max(self.sparsities)
+        self.mean_only = mean_only
+        self.seeds = seeds
+        self.mask = np.arange(self.M)[None, :] < self.sparsities[:, None]
+        self.hyperparams = None
+        self.telemetry = Telemetry()
+
+    def __str__(self):
+        return "GomPlexBatch-%d" % (self.B)
+
+    def fit(self, X, y, cost_type='nlml', freqs_update_rate=0.2, opt_rate=1,
+        max_iter=500, iter_tol=30, diff_tol=1e-3, early_stop=10,
+        optimizer='adaptive'):
+        assert cost_type in self.cost_types, "Invalid cost type!"
+        assert optimizer in self.optimizers, "Batched optimizer is elementwise!"
+        self.cost_type = cost_type
+        self.X_scaler = Scaler('minmax', X)
+        self.y_scaler = Scaler('normal', y)
+        self.X, self.y = self.X_scaler.eval(X), self.y_scaler.eval(y)
+        self.real_output = not np.any(np.iscomplex(y))
+        self.N, self.D = self.X.shape
+        if(self.hyperparams is None):
+            self.init_hyperparams()
+        self.train(freqs_update_rate, opt_rate, max_iter, iter_tol, diff_tol,
+            early_stop, optimizer)
+        return self
+
+    def init_hyperparams(self):
+        size = 3+self.D*self.M
+        self.hyperparams = np.zeros((self.B, size))
+        for b in range(self.B):
+            seed = None if self.seeds is None else self.seeds[b]
+            self.hyperparams[b] = npr.RandomState(seed).randn(size)
+        self.hyperparams[:, 3:] *= self.get_freqs_mask()
+
+    def get_freqs_mask(self, index=None):
+        mask = self.mask if index is None else self.mask[index]
+        return np.repeat(mask[:, None, :], self.D, 1).reshape(len(mask), -1)
+
+    def train(self, freqs_update_rate, opt_rate, max_iter, iter_tol, diff_tol,
+        early_stop, optimizer):
+        # Every model keeps its own best/div_count, converged models drop out
+        # of the batch and the rest keep advancing together
+        self.optimizer = Optimizer(optimizer, opt_rate)
+        self.iter = 0
+        self.min_cost = np.full(self.B, np.Infinity)
+        self.div_count = np.zeros((self.B, 1), dtype=int)
+        self.learned_hyperparams = self.hyperparams.copy()
+        self.active = np.ones(self.B, dtype=bool)
+        self.telemetry.reset()
+        self.start_time = time.time()
+        try:
+            while(self.iter < max_iter and np.any(self.active)):
+                grad = self.get_cost_grad(freqs_update_rate)
+                update = self.optimizer.update(self.hyperparams, grad, self)
+                self.hyperparams[self.active] = update[self.active]
+                self.record(iter_tol, diff_tol)
+        except KeyboardInterrupt:
+            self.telemetry.emit({'iter':self.iter, 'interrupted':True},
+                "  interrupted - keeping best hyperparameters so far", True)
+            self.hyperparams = self.learned_hyperparams.copy()
+            self.fit_state(self.hyperparams)
+            raise
+        self.hyperparams = self.learned_hyperparams.copy()
+        self.fit_state(self.hyperparams)
+
+    def record(self, iter_tol, diff_tol):
+        self.iter += 1
+        index = np.where(self.active)[0]
+        costs = self.get_costs(self.hyperparams[index], index)
+        improved = costs < self.min_cost[index]
+        big_improved = self.min_cost[index]-costs > diff_tol
+        self.div_count[index[improved & big_improved]] = 0
+        self.div_count[index[~(improved & big_improved)]] += 1
+        self.learned_hyperparams[index[improved]] =\
+            self.hyperparams[index[improved]]
+        self.min_cost[index[improved]] = costs[improved]
+        self.active[index[self.div_count[index, 0] >= iter_tol]] = False
+        self.telemetry.emit({
+            'iter':self.iter,
+            'costs':costs.tolist(),
+            'best_costs':self.min_cost.tolist(),
+            'active':int(np.sum(self.active)),
+            'elapsed':time.time()-self.start_time,
+        }, "  iter %d - best %.8f - active %d/%d"%(
+            self.iter, np.min(self.min_cost), np.sum(self.active), self.B))
+
+    def get_cost_grad(self, freqs_update_rate):
+        # Every probe perturbs the same coordinate of all active models, so
+        # one batched evaluation gives that partial derivative for the batch
+        index = np.where(self.active)[0]
+        hyperparams = self.hyperparams[index]
+        cur_costs = self.get_costs(hyperparams, index)
+        update_freqs_num = max(int(self.M*freqs_update_rate), 1)
+        freqs = npr.choice(range(self.M), update_freqs_num, replace=False)
+        coords = list(range(3))+[3+d*self.M+m
+            for m in freqs for d in range(self.D)]
+        grad = np.zeros_like(self.hyperparams)
+        with self.telemetry.phase('grad_probes'):
+            for j in coords:
+                hyperparams[:, j] += self.grad_epsilon
+                costs = self.get_costs(hyperparams, index)
+                hyperparams[:, j] -= self.grad_epsilon
+                grad[index, j] = (costs-cur_costs)/self.grad_epsilon
+        grad[:, 3:] *= self.get_freqs_mask()
+        return grad
+
+    def get_Phi(self, X, hyperparams, index):
+        # One GEMM against the stacked (D, B*M) frequencies
+        B = hyperparams.shape[0]
+        freqs = hyperparams[:, 3:].reshape(B, self.D, self.M)
+        X_sparse = X.dot(freqs.transpose(1, 0, 2).reshape(self.D, B*self.M))
+        X_sparse = X_sparse.reshape(X.shape[0], B, self.M).transpose(1, 0, 2)
+        kernel_scale = np.exp(hyperparams[:, 2])
+        Phi_const = np.sqrt(kernel_scale/self.sparsities[index])[:, None]
+        Phi_const = Phi_const*self.mask[index]
+        return Phi_const[:, None, :]*np.exp(-2j*np.pi*X_sparse)
+
+    def factorize(self, hyperparams, index):
+        with self.telemetry.phase('build_Phi'):
+            Phi = self.get_Phi(self.X, hyperparams, index)
+            Phi_H = Phi.conj().transpose(0, 2, 1)
+            noise = np.exp(hyperparams[:, 0])+np.exp(hyperparams[:, 1])*1j
+            PhiHy = np.matmul(Phi_H, self.y)
+        with self.telemetry.phase('factorize'):
+            # A = U (lam+noise) U^H as Phi^H Phi is Hermitian, padded columns
+            # only add noise to the spectrum and are divided out of det(A)
+            lam, U = np.linalg.eigh(np.matmul(Phi_H, Phi))
+            lam_noise = lam+noise[:, None]
+            inv_lam = 1/lam_noise
+            alpha = np.matmul(U, inv_lam[:, :, None]*np.matmul(
+                U.conj().transpose(0, 2, 1), PhiHy))
+            log_det_A = np.sum(np.log(lam_noise), 1)-\
+                (self.M-self.sparsities[index])*np.log(noise)
+        self.telemetry.count('train_calls')
+        return Phi, noise, U, inv_lam, alpha, log_det_A
+
+    def get_costs(self, hyperparams, index):
+        Phi, noise, U, inv_lam, alpha, log_det_A =\
+            self.factorize(hyperparams, index)
+        mu = np.matmul(Phi, alpha)
+        if(self.cost_type == 'nlml' and not self.mean_only):
+            goodness_of_fit = np.sum(self.y.conj()*(self.y-mu), (1, 2))/noise
+            noise_penalty = (self.N-self.sparsities[index])*np.log(noise)
+            return np.absolute(goodness_of_fit+log_det_A+noise_penalty)
+        mse_real = np.mean(np.real(self.y-mu)**2, (1, 2))
+        mse_imag = np.mean(np.imag(self.y-mu)**2, (1, 2))
+        if(self.cost_type == 'nmse'):
+            # Real targets have no imaginary variance to normalize by
+            if(self.real_output):
+                return mse_real/np.var(self.y.real)
+            return mse_real/np.var(self.y.real)/2+mse_imag/np.var(self.y.imag)/2
+        if(self.cost_type == 'rmse'):
+            return np.sqrt(mse_real/2+mse_imag/2)
+        return mse_real/2+mse_imag/2
+
+    def fit_state(self, hyperparams):
+        index = np.arange(self.B)
+        _, self.noise, self.U, self.inv_lam, self.alpha, self.log_det_A =\
+            self.factorize(hyperparams, index)
+
+    def predict(self, new_X, scaled=True, return_std=True):
+        X = np.array(new_X).copy()
+        if(scaled):
+            X = self.X_scaler.eval(X)
+        Phi = self.get_Phi(X, self.hyperparams, np.arange(self.B))
+        mu = np.matmul(Phi, self.alpha)
+        if(self.real_output):
+            mu = mu.real
+        if(scaled):
+            mu = self.y_scaler.eval(mu, inv=True)
+        if(self.mean_only or not return_std):
+            std = np.ones_like(mu)
+        else:
+            Phi_U = np.matmul(Phi, self.U)
+            Phi_inv_A_Phi_H = np.sum(np.absolute(Phi_U)**2*
+                self.inv_lam[:, None, :], 2)
+            std = np.sqrt(self.noise[:, None]*(1+Phi_inv_A_Phi_H))[:, :, None]
+        if(scaled):
+            std = std*(self.y_scaler._r_std_ if self.real_output else
+                self.y_scaler._r_std_+self.y_scaler._i_std_*1j)
+        return mu, std
+
+    def get_models(self):
+        # Unstack into standalone GomPlex models sharing the fitted scalers
+        models = []
+        for b, M in enumerate(self.sparsities):
+            gp = GomPlex(M, self.mean_only)
+            gp.X_scaler, gp.y_scaler = self.X_scaler, self.y_scaler
+            gp.cost_type, gp.cv_folds = self.cost_type, 1
+            gp.full_X, gp.full_y = self.X, self.y
+            gp.set_fidelity(1.)
+            gp.D = self.D
+            freqs = self.hyperparams[b, 3:].reshape(self.D, self.M)[:, :M]
+            gp.set_hyperparams(np.concatenate(
+                [self.hyperparams[b, :3], freqs.ravel()]))
+            models.append(gp)
+        return models
@@ -0,0 +1,141 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+import numpy as np
+import numpy.random as npr
+from scipy import linalg
+
+from .GomPlex import GomPlex
+
+def fit_member(args):
+    X, y, sparsity, mean_only, seed, fit_args = args
+    npr.seed(seed)
+    gp = GomPlex(sparsity, mean_only)
+    gp.telemetry.verbose = False
+    return gp.fit(X, y, **fit_args)
+
+class GomPlexEnsemble(object):
+
+    def __init__(self, members=10, sparsity=20, mean_only=False,
+        bootstrap=True, feature_ratio=1., n_jobs=1):
+        self.members = members
+        self.sparsity = sparsity
+        self.mean_only = mean_only
+        self.bootstrap = bootstrap
+        self.feature_ratio = feature_ratio
+        self.n_jobs = n_jobs
+        self.models, self.feature_indices = [], []
+        self.fused = None
+
+    def __str__(self):
+        return "GomPlexEnsemble-%d" % (len(self.models))
+
+    def fit(self, X, y, **fit_args):
+        X, y = np.asarray(X), np.asarray(y)
+        N, D = X.shape
+        D_sub = max(int(D*self.feature_ratio), 1)
+        tasks, feature_indices = [], []
+        for _ in range(self.members):
+            rows = npr.choice(N, N) if self.bootstrap else np.arange(N)
+            feats = np.arange(D) if D_sub == D else\
+                np.sort(npr.choice(D, D_sub, replace=False))
+            feature_indices.append(feats)
+            tasks.append((X[rows][:, feats], y[rows], self.sparsity,
+                self.mean_only, npr.randint(2**31), fit_args))
+        if(self.n_jobs > 1):
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(self.n_jobs) as executor:
+                models = list(executor.map(fit_member, tasks))
+        else:
+            models = list(map(fit_member, tasks))
+        self.models, self.feature_indices = [], []
+        for gp, feats in zip(models, feature_indices):
+            self.add(gp, feats)
+        return self
+
+    def add(self, gp, feature_index=None):
+        assert not gp.freqs_lattice, "Lattice models cannot be fused!"
+        if(feature_index is None):
+            feature_index = np.arange(gp.D)
+        self.models.append(gp)
+        self.feature_indices.append(np.asarray(feature_index))
+        self.fused = None
+        return self
+
+    def fuse(self):
+        # Every member's minmax scaling is already folded into its projection,
+        # so all members share one GEMM and one cos/sin pass on raw inputs
+        D = max(np.max(feats) for feats in self.feature_indices)+1
+        W, bias, Phi_const, alpha = [], [], [], []
+        for gp, feats in zip(self.models, self.feature_indices):
+            assert not hasattr(gp.X_scaler, '_i_min_'),\
+                "Fused prediction needs real inputs!"
+            proj = gp.get_projection()
+            W_scaled = np.zeros((D, gp.M))
+            W_scaled[feats] = proj['W']
+            W.append(W_scaled)
+            bias.append(proj['bias'])
+            Phi_const.append(np.full(gp.M, np.sqrt(gp.kernel_scale/gp.M)))
+            alpha.append(proj['alpha_scaled'][:, None])
+        self.fused = {
+            'D':D,
+            'W':np.hstack(W),
+            'bias':np.concatenate(bias),
+            'Phi_const':np.concatenate(Phi_const),
+            'alpha':linalg.block_diag(*alpha),
+            'starts':np.cumsum([0]+[gp.M for gp in self.models[:-1]]),
+        }
+        for attr in ['r_std', 'r_mu', 'i_std', 'i_mu']:
+            self.fused[attr] = np.array([np.ravel(getattr(
+                gp.y_scaler, '_%s_'%(attr), 0.))[0] for gp in self.models])
+        return self.fused
+
+    def predict_members(self, new_X, return_std=True):
+        fused = self.fused if self.fused is not None else self.fuse()
+        X = np.asarray(new_X).real
+        theta = X[:, :fused['D']].dot(fused['W'])
+        theta += fused['bias']
+        E = np.empty(theta.shape, dtype=np.complex128)
+        np.cos(theta, out=E.real)
+        np.sin(theta, out=E.imag)
+        # Block diagonal alphas reduce every member in one matmul
+        mus = E.dot(fused['alpha'])
+        mus = mus.real*fused['r_std']+fused['r_mu']+\
+            (mus.imag*fused['i_std']+fused['i_mu'])*1j
+        if(not return_std):
+            return mus, None
+        stds = np.zeros_like(mus)
+        for b, gp in enumerate(self.models):
+            scale = gp.y_scaler._r_std_+getattr(gp.y_scaler, '_i_std_', 0.)*1j
+            if(gp.mean_only):
+                stds[:, b] = np.ravel(scale)
+                continue
+            st = fused['starts'][b]
+            Phi = E[:, st:st+gp.M]*fused['Phi_const'][st:st+gp.M]
+            noise = gp.noise_real+gp.noise_imag*1j
+            if(gp.real_output):
+                Phi_real = gp.get_real_features(Phi)
+                Phi_inv_A_Phi_H = np.sum(Phi_real.dot(gp.inv_A)*Phi_real, 1)
+                noise = gp.noise_real
+            elif(gp.inv_A is None):
+                Phi_Phi_H = Phi.dot(gp.train_Phi.conj().T)
+                Phi_inv_A_Phi_H = (np.sum(np.absolute(Phi)**2, 1)-np.sum(
+                    Phi_Phi_H.dot(gp.inv_K)*Phi_Phi_H.conj(), 1))/noise
+            else:
+                Phi_inv_A_Phi_H = np.sum(Phi.dot(gp.inv_A)*Phi.conj(), 1)
+            stds[:, b] = np.sqrt(noise*(1+Phi_inv_A_Phi_H))*np.ravel(scale)
+        return mus, stds
+
+    def predict(self, new_X, return_std=True):
+        mus, stds = self.predict_members(new_X, return_std)
+        mu = np.mean(mus, 1)[:, None]
+        if(not return_std):
+            return mu, np.ones_like(mu)
+        # Mixture moments, real and imaginary parts separately
+        var_real = np.mean(stds.real**2+mus.real**2, 1)-mu[:, 0].real**2
+        var_imag = np.mean(stds.imag**2+mus.imag**2, 1)-mu[:, 0].imag**2
+        std = np.sqrt(np.maximum(var_real, 0))+\
+            np.sqrt(np.maximum(var_imag, 0))*1j
+        return mu, std[:, None]
@@ -4,7 +4,11 @@
 ################################################################################
 
 from .GomPlex import GomPlex
+from .GomPlexBatch import GomPlexBatch
+from .GomPlexEnsemble import GomPlexEnsemble
 
 __all__ = [
-    'GomPlex'
+    'GomPlex',
+    'GomPlexBatch',
+    'GomPlexEnsemble'
 ]
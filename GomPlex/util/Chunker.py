@@ -0,0 +1,96 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+import threading
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__all__ = [
+    "Chunker"
+]
+
+class Chunker(object):
+
+    def __init__(self, source, chunk_size=65536, prefetch=2, delimiter=',',
+        skip_header=0):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.delimiter = delimiter
+        self.skip_header = skip_header
+
+    def __iter__(self):
+        # Chunk N+1 is read and decoded by a worker thread while the consumer
+        # works on chunk N, at most prefetch chunks are held in memory
+        if(self.prefetch < 1):
+            for chunk in self.read_chunks():
+                yield chunk
+            return
+        chunks = queue.Queue(maxsize=self.prefetch)
+        done, stop = object(), threading.Event()
+        def put(item):
+            # Gives up once the consumer has stopped, so join() never hangs
+            while(not stop.is_set()):
+                try:
+                    chunks.put(item, timeout=.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        def reader():
+            try:
+                for chunk in self.read_chunks():
+                    if(not put(chunk)):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while(True):
+                chunk = chunks.get()
+                if(chunk is done):
+                    break
+                if(isinstance(chunk, Exception)):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+            thread.join()
+
+    def read_chunks(self):
+        source = self.source
+        if(isinstance(source, str)):
+            if(source.endswith('.npy')):
+                source = np.load(source, mmap_mode='r')
+            else:
+                for chunk in self.read_text_chunks(source):
+                    yield chunk
+                return
+        if(hasattr(source, 'shape')):
+            # Memmap slices are only paged in when the copy is made here
+            for st in range(0, source.shape[0], self.chunk_size):
+                yield np.array(source[st:st+self.chunk_size])
+            return
+        for chunk in source:
+            yield np.asarray(chunk)
+
+    def read_text_chunks(self, path):
+        with open(path, 'r') as text_f:
+            for _ in range(self.skip_header):
+                next(text_f)
+            lines = []
+            for line in text_f:
+                lines.append(line)
+                if(len(lines) == self.chunk_size):
+                    yield np.loadtxt(lines, delimiter=self.delimiter, ndmin=2)
+                    lines = []
+            if(len(lines) > 0):
+                yield np.loadtxt(lines, delimiter=self.delimiter, ndmin=2)
@@ -0,0 +1,134 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+import numpy as np
+import numpy.random as npr
+from scipy import linalg, sparse
+
+__all__ = [
+    "Coreset"
+]
+
+class Coreset(object):
+
+    methods = ['leverage', 'kmeans']
+
+    def __init__(self, method='leverage', size=1000, tol=0.05, max_size=None,
+        sketch_size=None, jl_dim=32, uniform_mix=0.1, kmeans_iter=10,
+        tile_size=8192, check_every=10, kmeans_clusters=None):
+        assert method in self.methods, "Invalid coreset method!"
+        self.method = method
+        self.size = size
+        self.tol = tol
+        self.max_size = max_size
+        self.sketch_size = sketch_size
+        self.jl_dim = jl_dim
+        self.uniform_mix = uniform_mix
+        self.kmeans_iter = kmeans_iter
+        self.tile_size = tile_size
+        self.check_every = check_every
+        self.kmeans_clusters = kmeans_clusters
+
+    def sample(self, gp, size):
+        return getattr(self, 'sample_'+self.method)(gp, size)
+
+    def get_features(self, gp, X):
+        Phi = np.sqrt(gp.kernel_scale/gp.M)*np.exp(-2j*np.pi*gp.project(X))
+        return gp.get_real_features(Phi) if gp.real_output else Phi
+
+    def get_leverage_scores(self, gp):
+        # Ridge leverage phi_i inv(A) phi_i^H: A is taken from a CountSketch of
+        # Phi and the row norms of Phi inv(L)^H from a JL projection, so Phi
+        # is streamed twice in tiles and never held
+        X, N = gp.X, gp.X.shape[0]
+        width = 2*gp.M if gp.real_output else gp.M
+        sketch_size = self.sketch_size or min(4*width, N)
+        buckets = npr.randint(sketch_size, size=N)
+        signs = npr.choice([-1., 1.], N)
+        S_Phi = 0.
+        for st in range(0, N, self.tile_size):
+            ed = min(st+self.tile_size, N)
+            S = sparse.csr_matrix((signs[st:ed], (buckets[st:ed],
+                np.arange(ed-st))), shape=(sketch_size, ed-st))
+            S_Phi = S_Phi+S.dot(self.get_features(gp, X[st:ed]))
+        A = S_Phi.conj().T.dot(S_Phi)+gp.noise_real*np.eye(width)
+        L = linalg.cholesky(A, lower=True)
+        B = linalg.solve_triangular(L, npr.randn(width, self.jl_dim),
+            trans='C', lower=True)/np.sqrt(self.jl_dim)
+        scores = np.empty(N)
+        for st in range(0, N, self.tile_size):
+            ed = min(st+self.tile_size, N)
+            Phi_B = self.get_features(gp, X[st:ed]).dot(B)
+            scores[st:ed] = np.sum(np.absolute(Phi_B)**2, 1)
+        return scores
+
+    def sample_leverage(self, gp, size):
+        # Importance sampling with replacement, mixed with uniform so that no
+        # row has a vanishing probability; repeats are merged into weights
+        N = gp.X.shape[0]
+        scores = self.get_leverage_scores(gp)
+        probs = (1-self.uniform_mix)*scores/np.sum(scores)+self.uniform_mix/N
+        index = npr.choice(N, size, p=probs)
+        index, counts = np.unique(index, return_counts=True)
+        weights = counts/(size*probs[index])
+        return gp.X[index], gp.y[index], weights
+
+    def get_kmeans_labels(self, points, centroids):
+        # Tiles of about 2^20 distances stay in cache, the pass is memory bound
+        N = points.shape[0]
+        labels, dists = np.empty(N, dtype=int), np.empty(N)
+        centroids_sq = np.sum(centroids**2, 1)
+        tile_size = max(2**20//centroids.shape[0], 1)
+        for st in range(0, N, tile_size):
+            ed = min(st+tile_size, N)
+            tile_dists = points[st:ed].dot(centroids.T)
+            tile_dists *= -2
+            tile_dists += centroids_sq
+            labels[st:ed] = np.argmin(tile_dists, 1)
+            dists[st:ed] = tile_dists[np.arange(ed-st), labels[st:ed]]
+        return labels, dists+np.sum(points**2, 1)
+
+    def kmeans(self, points, k):
+        # k-means++ seeding with incrementally kept distances, then Lloyd
+        # iterations with distances from one GEMM per tile
+        N = points.shape[0]
+        points_sq = np.sum(points**2, 1)
+        get_dists = lambda i:points_sq-2*points.dot(points[i])+points_sq[i]
+        index = [npr.randint(N)]
+        min_dists = get_dists(index[0])
+        for _ in range(k-1):
+            cum_dists = np.cumsum(np.maximum(min_dists, 0))
+            i = min(np.searchsorted(cum_dists, npr.rand()*cum_dists[-1]), N-1)
+            index.append(i)
+            np.minimum(min_dists, get_dists(i), out=min_dists)
+        centroids = points[index]
+        for _ in range(self.kmeans_iter):
+            labels, _ = self.get_kmeans_labels(points, centroids)
+            counts = np.bincount(labels, minlength=k)
+            sums = np.column_stack([np.bincount(labels, points[:, d],
+                minlength=k) for d in range(points.shape[1])])
+            filled = counts > 0
+            centroids[filled] = sums[filled]/counts[filled, None]
+        return self.get_kmeans_labels(points, centroids)
+
+    def sample_kmeans(self, gp, size):
+        # Stratified sampling: every cluster gets a share of the size in
+        # proportion to its rows, drawn without replacement and weighted by
+        # the inverse inclusion rate, so rows keep their own targets and the
+        # weighted cost stays unbiased; far fewer clusters than rows keep
+        # the k-means passes cheap
+        assert not sparse.issparse(gp.X), "K-means coreset needs dense inputs!"
+        X, y, N = gp.X, gp.y, gp.X.shape[0]
+        points = np.hstack((X.real, X.imag)) if np.iscomplexobj(X) else X
+        k = min(self.kmeans_clusters or max(size//10, 1), size, N)
+        labels, _ = self.kmeans(points, k)
+        counts = np.bincount(labels, minlength=k)
+        shares = np.minimum(np.maximum(np.round(counts*size/N), 1), counts)
+        order = np.lexsort((npr.rand(N), labels))
+        starts = np.cumsum(counts)-counts
+        ranks = np.arange(N)-starts[labels[order]]
+        index = order[ranks < shares[labels[order]]]
+        weights = counts/np.maximum(shares, 1)
+        return X[index], y[index], weights[labels[index]]
@@ -3,8 +3,13 @@
 #  Author:Max W. Y. Lam (maxingaussian@gmail.com)
 ################################################################################
 
+import os
+import json
 import numpy as np
+import numpy.random as npr
+from timeit import Timer
 from scipy import linalg
+from scipy.linalg import blas
 from scipy.sparse import csr_matrix
 from numpy.fft import fft, ifft, fftshift, ifftshift
 
@@ -12,9 +17,19 @@ def ndft(x, f_hat, M):
     k = -(M//2)+np.arange(M)
     return np.dot(np.exp(-2j*np.pi*k*x[:, None]), f_hat)
     
-def nfft(x, f_hat, M, sigma=2, tol=1e-8):
-    n = M*sigma
-    m = np.ceil(-np.log(0.25*tol/M)/(np.pi*(1-1/(2*sigma-1))))
+def get_nfft_grid_size(M, sigma):
+    return int(np.ceil(M*sigma/2))*2
+
+def get_nfft_window_size(M, sigma, tol):
+    return np.ceil(-np.log(0.25*tol/M)/(np.pi*(1-1/(2*sigma-1))))
+
+def get_nfft_error_bound(M, sigma, m):
+    # Gaussian window error bound relative to the l1 norm of the coefficients
+    return 4*M*np.exp(-m*np.pi*(1-1/(2*sigma-1)))
+
+def nfft(x, f_hat, M, sigma=2, tol=1e-8, m=None):
+    n = get_nfft_grid_size(M, sigma)
+    m = get_nfft_window_size(M, sigma, tol) if m is None else m
     shift = lambda x:-0.5+(x+0.5)%1
     k = -(M//2)+np.arange(M)
     b = (2*sigma*m)/((2*sigma-1)*np.pi)
@@ -40,9 +55,9 @@ def adj_ndft(x, f, M):
     k = -(M//2)+np.arange(M)
     return np.dot(np.exp(2j*np.pi*x*k[:, None]), f)
     
-def adj_nfft(x, f, M, sigma=2, tol=1e-8):
-    n = M*sigma
-    m = np.ceil(-np.log(0.25*tol/M)/(np.pi*(1-1/(2*sigma-1))))
+def adj_nfft(x, f, M, sigma=2, tol=1e-8, m=None):
+    n = get_nfft_grid_size(M, sigma)
+    m = get_nfft_window_size(M, sigma, tol) if m is None else m
     shift = lambda x:-0.5+(x+0.5)%1
     col_ind = np.floor(n*x[:, None]).astype(int)+np.arange(-m, m)
     b = (2*sigma*m)/((2*sigma-1)*np.pi)
@@ -64,6 +79,51 @@ def faster_adj_nfft(n, q, mat, f, M, sigma=2, tol=1e-8):
     f_hat = g_hat/q
     return f_hat
 
+NFFT_PLAN_CACHE = os.path.join(os.path.expanduser('~'), '.GomPlex',
+    'nfft_plans.json')
+
+def tune_nfft(N, M, tol=1e-8, sigmas=(1.25, 1.5, 2, 3), time_reps=3,
+    probe_size=256, cache_path=NFFT_PLAN_CACHE, refresh=False):
+    key = '%d_%d_%g'%(N, M, tol)
+    cache = {}
+    if(cache_path is not None and os.path.exists(cache_path)):
+        with open(cache_path, 'r') as cache_f:
+            cache = json.load(cache_f)
+    if(key in cache and not refresh):
+        return NFFTPlan(M, **cache[key])
+    x = npr.rand(N)-.5
+    f_hat = npr.randn(M)+1j*npr.randn(M)
+    probe = x[:probe_size]
+    f_true = ndft(probe, f_hat, M)
+    f_hat_l1 = np.sum(np.abs(f_hat))
+    get_error = lambda f:np.max(np.abs(f[:probe_size]-f_true))/f_hat_l1
+    timeit = lambda fun:Timer(fun).timeit(time_reps)/time_reps
+    best = {'sigma':None, 'm':None, 'error':0.,
+        'error_bound':0., 'time':timeit(lambda:ndft(x, f_hat, M))}
+    for sigma in sigmas:
+        m = get_nfft_window_size(M, sigma, tol)
+        error = get_error(nfft(x, f_hat, M, sigma, m=m))
+        if(error > tol):
+            continue
+        # The error bound is pessimistic, shrink the window while it holds
+        while(m > 1):
+            smaller_error = get_error(nfft(x, f_hat, M, sigma, m=m-1))
+            if(smaller_error > tol):
+                break
+            m, error = m-1, smaller_error
+        time = timeit(lambda:nfft(x, f_hat, M, sigma, m=m))
+        if(time < best['time']):
+            best = {'sigma':sigma, 'm':float(m), 'error':float(error),
+                'error_bound':float(get_nfft_error_bound(M, sigma, m)),
+                'time':time}
+    if(cache_path is not None):
+        cache[key] = best
+        if(not os.path.exists(os.path.dirname(cache_path))):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, 'w') as cache_f:
+            json.dump(cache, cache_f, indent=2)
+    return NFFTPlan(M, **best)
+
 def numpy_solve_Phi(y, x, M):
     k = -(M//2)+np.arange(M)
     Phi = np.exp(-2j*np.pi*k*x[:, None])
@@ -201,14 +261,10 @@ def get_x_nfft(X, spectral_freqs, kernel_scale, M):
 def get_y_nfft(y, K):
     return np.repeat(y.ravel(), K)
 
+
 def interp_Phi_by_basis(Phi, phi_basis):
-    W_H = np.zeros((phi_basis.shape[0], Phi.shape[0]))+0j
-    H_basis = np.concatenate(([phi_basis[0]], phi_basis[1:][::-1])).conj()
-    fft_basis = np.fft.fft(H_basis)
-    Phi_basis = linalg.circulant(phi_basis)
-    for i in range(Phi.shape[0]):
-        W_H[:, i] = np.fft.ifft(np.fft.fft(Phi[i, :].conj())/fft_basis)
-    return W_H.conj().T
+    C = CirculantOperator(phi_basis)
+    return C.solve(Phi.conj().T, adjoint=True).conj().T
 
 def get_Phi_by_basis(W, Phi_basis):
     return circulant_mul(Phi_basis, W.conj().T, True).conj().T
@@ -226,24 +282,285 @@ def get_Phi_by_FFT(W, vert=True):
         return np.fft.ifft(W)
     
 def circulant_mul(C, X, conj_trans=False):
-    CX = np.zeros((C.shape[0], X.shape[1]))+0j
-    fft_cir = np.fft.fft(C[0, :].conj() if conj_trans else C[:, 0])
-    for i in range(X.shape[1]):
-        CX[:, i] = np.fft.ifft(fft_cir*np.fft.fft(X[:, i]))
-    return CX
-
-def fast_solve_circulant(Q, Phi_basis, X, tol=1e-8):
-    f = np.zeros((Phi_basis.shape[0], X.shape[1]))+0j
-    _r = X-circulant_mul(Phi_basis, f)
-    p = circulant_mul(Phi_basis, _r, True)
-    while(True):
-        a = np.sum(_r.conj()*_r, 0)/np.sum(p.conj()*(Q.dot(p)), 0)
-        f += a*Q.dot(p)
-        r = _r-a*circulant_mul(Phi_basis, Q.dot(p))
-        b = np.sum(r.conj()*r, 0)/np.sum(_r.conj()*_r, 0)
-        p = b*p+circulant_mul(Phi_basis, r, True)
-        if(r < tol):
+    return CirculantOperator(C[:, 0]).matvec(X, adjoint=conj_trans)
+
+def batch_dot(U, V):
+    return np.sum(U.conj()*V, 0)
+
+def fwht(X):
+    # Unnormalized Walsh-Hadamard transform along the last axis (length 2^k)
+    shape = X.shape
+    n = shape[-1]
+    assert n & (n-1) == 0, "Hadamard transform needs a power of 2 length!"
+    X, h = np.array(X), 1
+    while(h < n):
+        X = X.reshape(shape[:-1]+(n//(2*h), 2, h))
+        X = np.stack((X[..., 0, :]+X[..., 1, :], X[..., 0, :]-X[..., 1, :]), -2)
+        h *= 2
+    return X.reshape(shape)
+
+def blocked_gram(X, project, y, M, Phi_const=1., real=False, tile_size=2048,
+    n_threads=1, weights=None):
+    # Phi^H Phi and Phi^H y of Phi = Phi_const*exp(-2j*pi*project(X)), or of
+    # the real [cos, sin] features, rows optionally scaled by weights, are
+    # accumulated over row tiles: every worker writes its tile into one reused
+    # Fortran buffer and updates the upper triangle by a rank-k herk/syrk, so
+    # no N x M array is ever formed
+    N = X.shape[0]
+    width, dtype = (2*M, np.float64) if real else (M, np.complex128)
+    rank_k = blas.dsyrk if real else blas.zherk
+    trans = 1 if real else 2
+    def work(tiles):
+        buf = np.empty((tile_size, width), dtype=dtype, order='F')
+        G = np.zeros((width, width), dtype=dtype, order='F')
+        Phi_H_y = np.zeros((width, y.shape[1]), dtype=dtype)
+        for st in tiles:
+            ed = min(st+tile_size, N)
+            theta = project(X[st:ed])
+            theta *= 2*np.pi
+            Phi = buf if ed-st == tile_size else\
+                np.empty((ed-st, width), dtype=dtype, order='F')
+            if(np.iscomplexobj(theta)):
+                # Complex inputs give complex phases, no cos/sin split
+                if(real):
+                    E = np.exp(-1j*theta)
+                    Phi[:, :M], Phi[:, M:] = E.real, -E.imag
+                else:
+                    Phi[:] = np.exp(-1j*theta)
+            elif(real):
+                np.cos(theta, out=Phi[:, :M])
+                np.sin(theta, out=Phi[:, M:])
+            else:
+                np.cos(theta, out=Phi.real)
+                np.sin(theta, out=Phi.imag)
+                np.negative(Phi.imag, out=Phi.imag)
+            Phi *= Phi_const
+            if(weights is not None):
+                Phi *= weights[st:ed, None]
+            G = rank_k(1., Phi, 1., G, trans=trans, overwrite_c=1)
+            Phi_H_y += Phi.conj().T.dot(y[st:ed])
+        return G, Phi_H_y
+    tiles = list(range(0, N, tile_size))
+    if(n_threads > 1 and len(tiles) > 1):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(n_threads) as executor:
+            parts = list(executor.map(work,
+                [tiles[i::n_threads] for i in range(n_threads)]))
+        G = sum(part[0] for part in parts)
+        Phi_H_y = sum(part[1] for part in parts)
+    else:
+        G, Phi_H_y = work(tiles)
+    G = np.triu(G)+np.triu(G, 1).conj().T
+    return G, Phi_H_y
+
+def cg_solve(matvec, B, precond=None, tol=1e-8, max_iter=None, x0=None):
+    # Preconditioned CG run on all columns of B at once, Hermitian systems only
+    vec = B.ndim == 1
+    B = B[:, None] if vec else B
+    X = np.zeros(B.shape, dtype=np.result_type(B, 1j))
+    if(x0 is not None):
+        X += x0[:, None] if vec else x0
+    R = B-matvec(X)
+    Z = R if precond is None else precond(R)
+    P = Z.copy()
+    rz = batch_dot(R, Z)
+    b_norm = np.sqrt(np.sum(np.absolute(B)**2, 0))
+    b_norm[b_norm == 0] = 1
+    max_iter = B.shape[0]*2 if max_iter is None else max_iter
+    for _ in range(max_iter):
+        res = np.sqrt(np.sum(np.absolute(R)**2, 0))/b_norm
+        active = res > tol
+        if(not np.any(active)):
             break
-        _r = r
-    return f
-        
\ No newline at end of file
+        AP = matvec(P)
+        pAp = batch_dot(P, AP)
+        a = np.where(active, rz/np.where(pAp == 0, 1, pAp), 0)
+        X += a*P
+        R -= a*AP
+        Z = R if precond is None else precond(R)
+        _rz = rz
+        rz = batch_dot(R, Z)
+        P = Z+(rz/np.where(_rz == 0, 1, _rz))*P
+    return X[:, 0] if vec else X
+
+def fast_solve_circulant(Q, Phi_basis, X, tol=1e-8, max_iter=None):
+    # Preconditioned CGLS for Phi_basis f = X with preconditioner Q
+    C = CirculantOperator(Phi_basis[:, 0])
+    vec = X.ndim == 1
+    X = X[:, None] if vec else X
+    precond = (lambda S:S) if Q is None else Q.dot
+    f = np.zeros((C.n, X.shape[1]))+0j
+    r = X.copy()+0j
+    s = C.matvec(r, adjoint=True)
+    z = precond(s)
+    p = z.copy()
+    gamma = batch_dot(s, z)
+    s_norm = np.sqrt(np.sum(np.absolute(s)**2, 0))
+    s_norm[s_norm == 0] = 1
+    max_iter = C.n*2 if max_iter is None else max_iter
+    for _ in range(max_iter):
+        q = C.matvec(p)
+        qq = batch_dot(q, q).real
+        a = gamma/np.where(qq == 0, 1, qq)
+        f += a*p
+        r -= a*q
+        s = C.matvec(r, adjoint=True)
+        if(np.all(np.sqrt(np.sum(np.absolute(s)**2, 0))/s_norm < tol)):
+            break
+        z = precond(s)
+        _gamma = gamma
+        gamma = batch_dot(s, z)
+        p = z+(gamma/np.where(_gamma == 0, 1, _gamma))*p
+    return f[:, 0] if vec else f
+
+
+class CirculantOperator(object):
+    
+    def __init__(self, c):
+        self.c = np.asarray(c)
+        self.n = self.c.shape[0]
+        self.eigs = fft(self.c)
+    
+    @property
+    def shape(self):
+        return (self.n, self.n)
+    
+    def matvec(self, X, adjoint=False):
+        eigs = self.eigs.conj() if adjoint else self.eigs
+        if(X.ndim == 1):
+            return ifft(eigs*fft(X))
+        return ifft(eigs[:, None]*fft(X, axis=0), axis=0)
+    
+    def rmatvec(self, X):
+        return self.matvec(X, adjoint=True)
+    
+    def solve(self, X, adjoint=False):
+        eigs = self.eigs.conj() if adjoint else self.eigs
+        if(X.ndim == 1):
+            return ifft(fft(X)/eigs)
+        return ifft(fft(X, axis=0)/eigs[:, None], axis=0)
+    
+    def to_dense(self):
+        return linalg.circulant(self.c)
+
+
+class ToeplitzOperator(object):
+    
+    def __init__(self, c, r=None):
+        self.c = np.asarray(c)
+        self.r = self.c.conj() if r is None else np.asarray(r)
+        self.n = self.c.shape[0]
+        self.hermitian = r is None or (np.allclose(self.c, self.r.conj()) and
+            np.isreal(self.c[0]))
+        embed = np.concatenate([self.c, [0], self.r[1:][::-1]])
+        self.embedding = CirculantOperator(embed)
+        self.precond = None
+    
+    @property
+    def shape(self):
+        return (self.n, self.n)
+    
+    def matvec(self, X, adjoint=False):
+        pad = [(0, self.n)]+[(0, 0)]*(X.ndim-1)
+        return self.embedding.matvec(np.pad(X, pad), adjoint)[:self.n]
+    
+    def rmatvec(self, X):
+        return self.matvec(X, adjoint=True)
+    
+    def get_circulant_preconditioner(self):
+        # T. Chan's optimal circulant approximation of the Toeplitz matrix
+        if(self.precond is None):
+            j = np.arange(1, self.n)
+            chan = np.zeros(self.n, dtype=np.result_type(self.c, self.r))
+            chan[0] = self.c[0]
+            chan[1:] = ((self.n-j)*self.c[1:]+j*self.r[::-1][:-1])/self.n
+            self.precond = CirculantOperator(chan)
+        return self.precond
+    
+    def solve(self, B, tol=1e-8, max_iter=None, x0=None):
+        C = self.get_circulant_preconditioner()
+        if(self.hermitian):
+            return cg_solve(self.matvec, B, C.solve, tol, max_iter, x0)
+        normal_matvec = lambda X:self.matvec(self.matvec(X), adjoint=True)
+        normal_precond = lambda X:C.solve(C.solve(X, adjoint=True))
+        return cg_solve(normal_matvec, self.matvec(B, adjoint=True),
+            normal_precond, tol, max_iter, x0)
+    
+    def to_dense(self):
+        return linalg.toeplitz(self.c, self.r)
+
+
+class FastfoodOperator(object):
+    
+    # Fastfood frequencies W^T = [S H G P H B]_blocks with fixed random signs
+    # B and permutations P, learned diagonals G and S, D padded to 2^k
+    
+    def __init__(self, D, M, B=None, P=None):
+        self.D, self.M = D, M
+        self.D_pad = 1 << int(np.ceil(np.log2(max(D, 2))))
+        self.n_blocks = int(np.ceil(M/self.D_pad))
+        self.M_pad = self.n_blocks*self.D_pad
+        self.B = npr.choice([-1., 1.], (self.n_blocks, self.D_pad))\
+            if B is None else B
+        self.P = np.array([npr.permutation(self.D_pad)
+            for _ in range(self.n_blocks)]) if P is None else P
+        self.G, self.S = np.ones(self.M_pad), np.ones(self.M)
+    
+    @property
+    def shape(self):
+        return (self.D, self.M)
+    
+    def init_diagonals(self):
+        # Rows of H G P H B have norm sqrt(D_pad)*|G| as the rows of P H B are
+        # orthogonal with norm sqrt(D_pad), S divides that out and rescales
+        # them to chi(D_pad) distributed norms like a dense Gaussian matrix
+        self.G = npr.randn(self.M_pad)
+        G_norms = np.repeat(np.linalg.norm(np.reshape(
+            self.G, (self.n_blocks, self.D_pad)), axis=1), self.D_pad)
+        chi = np.sqrt(np.sum(npr.randn(self.M_pad, self.D_pad)**2, 1))
+        self.S = (chi/(np.sqrt(self.D_pad)*G_norms))[:self.M]
+        return self
+    
+    def set_diagonals(self, G, S):
+        self.G, self.S = G, S
+    
+    def matvec(self, X):
+        # X.dot(W) in O(N M log D) without forming W
+        X_pad = np.zeros((X.shape[0], self.D_pad), dtype=X.dtype)
+        X_pad[:, :self.D] = X
+        X_pad = X_pad[:, None, :]*self.B
+        X_pad = fwht(X_pad)
+        X_pad = np.take_along_axis(X_pad, self.P[None], 2)
+        X_pad = fwht(X_pad*np.reshape(self.G, (self.n_blocks, self.D_pad)))
+        return X_pad.reshape(X.shape[0], self.M_pad)[:, :self.M]*self.S
+    
+    def to_dense(self):
+        return self.matvec(np.eye(self.D))
+
+
+class NFFTPlan(object):
+    
+    def __init__(self, M, sigma=None, m=None, error=0., error_bound=0.,
+        time=None):
+        self.M = M
+        self.sigma = sigma
+        self.m = m
+        self.error = error
+        self.error_bound = error_bound
+        self.time = time
+        self.use_ndft = sigma is None
+    
+    def __str__(self):
+        if(self.use_ndft):
+            return "NFFTPlan-ndft"
+        return "NFFTPlan-sigma%g-m%d" % (self.sigma, self.m)
+    
+    def forward(self, x, f_hat):
+        if(self.use_ndft):
+            return ndft(x, f_hat, self.M)
+        return nfft(x, f_hat, self.M, self.sigma, m=self.m)
+    
+    def adjoint(self, x, f):
+        if(self.use_ndft):
+            return adj_ndft(x, f, self.M)
+        return adj_nfft(x, f, self.M, self.sigma, m=self.m)
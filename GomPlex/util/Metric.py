@@ -22,40 +22,61 @@ class Metric(object):
         "nlml"
     ]
     
-    def __init__(self, metric, gp=None):
+    std_free_metrics = [
+        "mse",
+        "rmse",
+        "nmse",
+        "mae",
+        "nlml"
+    ]
+    
+    def __init__(self, metric, gp=None, weights=None):
         assert metric in self.metrics, "Invalid metric!"
         self.metric = metric  
         self.gp = gp
+        self.weights = weights
 
     def eval(self, target, mu_pred, std_pred):
         return getattr(self, self.metric)(target, mu_pred, std_pred)
 
+    def mean(self, values):
+        # Row weights let a weighted subset stand in for the full data
+        if(self.weights is None):
+            return np.mean(values)
+        weights = np.reshape(self.weights, (-1,)+(1,)*(np.ndim(values)-1))
+        return np.sum(weights*values)/np.sum(weights*np.ones_like(values))
+
+    def var(self, values):
+        if(self.weights is None):
+            return np.var(values)
+        return self.mean(np.absolute(values-self.mean(values))**2)
+
     def mse(self, target, mu_pred, std_pred):        
-        mse_real = np.mean(np.real(target-mu_pred)**2)
-        mse_imag = np.mean(np.imag(target-mu_pred)**2)
+        mse_real = self.mean(np.real(target-mu_pred)**2)
+        mse_imag = self.mean(np.imag(target-mu_pred)**2)
         return mse_real/2+mse_imag/2
 
     def rmse(self, target, mu_pred, std_pred):        
-        mse_real = np.mean(np.real(target-mu_pred)**2)
-        mse_imag = np.mean(np.imag(target-mu_pred)**2)
+        mse_real = self.mean(np.real(target-mu_pred)**2)
+        mse_imag = self.mean(np.imag(target-mu_pred)**2)
         return (mse_real/2+mse_imag/2)**0.5
 
     def nmse(self, target, mu_pred, std_pred):
-        mse_real = np.mean(np.real(target-mu_pred)**2)
-        nmse_real = mse_real/np.var(np.real(target))
-        if(np.var(np.imag(target)) > 0):
-            mse_imag = np.mean(np.imag(target-mu_pred)**2)
-            nmse_imag = mse_imag/np.var(np.imag(target))
+        mse_real = self.mean(np.real(target-mu_pred)**2)
+        nmse_real = mse_real/self.var(np.real(target))
+        if(self.var(np.imag(target)) > 0):
+            mse_imag = self.mean(np.imag(target-mu_pred)**2)
+            nmse_imag = mse_imag/self.var(np.imag(target))
             return nmse_real/2+nmse_imag/2
         return nmse_real
 
     def mae(self, target, mu_pred, std_pred):
-        mae = np.mean(np.abs(target.real-mu_pred.real))+\
-            np.mean(np.abs(target.imag-mu_pred.imag))
+        mae = self.mean(np.abs(target.real-mu_pred.real))+\
+            self.mean(np.abs(target.imag-mu_pred.imag))
         return mae/2
 
     def nlpd(self, target, mu_pred, std_pred):        
-        nlpd = np.mean(((target-mu_pred)/std_pred)**2+2*np.log(std_pred))
+        nlpd = self.mean(((target-mu_pred)/std_pred)**2+2*np.log(std_pred))
         nlpd = 0.5*(np.log(2*np.pi)+nlpd)
         return np.absolute(nlpd)
 
@@ -71,8 +92,14 @@ class Metric(object):
         if(self.gp.mean_only):
             return self.mse(target, mu_pred, std_pred)
         noise = self.gp.noise_real+self.gp.noise_imag*1j
-        goodness_of_fit = (target.conj().T.dot(target-mu_pred))/noise
-        covariance_penalty = np.sum(np.log(np.diagonal(self.gp.T)))
-        noise_penalty = (self.gp.N-self.gp.M)*np.log(noise)
+        A_dim = self.gp.M
+        if(getattr(self.gp, 'real_output', False)):
+            noise, A_dim = self.gp.noise_real, 2*self.gp.M
+        residual = target-mu_pred
+        if(self.weights is not None):
+            residual = np.reshape(self.weights, (-1, 1))*residual
+        goodness_of_fit = (target.conj().T.dot(residual))/noise
+        covariance_penalty = self.gp.log_det_A
+        noise_penalty = (self.gp.N-A_dim)*np.log(noise)
         nlml = goodness_of_fit+covariance_penalty+noise_penalty
         return np.absolute(nlml[0, 0])
@@ -0,0 +1,86 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+import numpy as np
+
+__all__ = [
+    "Optimizer"
+]
+
+class Optimizer(object):
+    
+    optimizers = [
+        "adaptive",
+        "adam",
+        "linesearch",
+        "lbfgs",
+    ]
+    
+    # Curvature pairs and sufficient decrease tests need the exact gradient
+    full_grad_optimizers = ["linesearch", "lbfgs"]
+    
+    adam_rate, adam_beta1, adam_beta2 = 0.05, 0.9, 0.999
+    armijo_c, backtrack_rate, max_backtracks = 1e-4, 0.5, 8
+    
+    def __init__(self, optimizer, opt_rate=1):
+        assert optimizer in self.optimizers, "Invalid optimizer!"
+        self.optimizer = optimizer
+        self.opt_rate = opt_rate
+        self.state = {}
+    
+    def __str__(self):
+        return self.optimizer
+    
+    def update(self, hyperparams, grad, trainer):
+        assert self.optimizer != "lbfgs", "L-BFGS is driven by the Trainer!"
+        return getattr(self, self.optimizer)(hyperparams, grad, trainer)
+
+    def adaptive(self, hyperparams, grad, trainer):
+        if('mem' not in self.state.keys()):
+            self.state['mem'] = np.ones(hyperparams.shape)
+            self.state['g'] = np.zeros(hyperparams.shape)
+            self.state['g2'] = np.zeros(hyperparams.shape)
+        mem, g, g2 = self.state['mem'], self.state['g'], self.state['g2']
+        r = 1/(mem+1)
+        g = (1-r)*g+r*grad
+        g2 = (1-r)*g2+r*grad**2
+        rate1 = g*g/(g2+1e-16)
+        mem = mem*(1-rate1)+1
+        rate2 = self.opt_rate/(np.maximum(trainer.div_count, 7))
+        rate = np.minimum(rate1, rate2)/(np.sqrt(g2)+1e-16)
+        self.state.update(mem=mem, g=g, g2=g2, rate=rate)
+        return hyperparams-grad*rate
+
+    def adam(self, hyperparams, grad, trainer):
+        if('m' not in self.state.keys()):
+            self.state['m'] = np.zeros(hyperparams.shape)
+            self.state['v'] = np.zeros(hyperparams.shape)
+            self.state['t'] = 0
+        b1, b2 = self.adam_beta1, self.adam_beta2
+        t = self.state['t']+1
+        m = b1*self.state['m']+(1-b1)*grad
+        v = b2*self.state['v']+(1-b2)*grad**2
+        m_hat, v_hat = m/(1-b1**t), v/(1-b2**t)
+        self.state.update(m=m, v=v, t=t)
+        rate = self.opt_rate*self.adam_rate
+        return hyperparams-rate*m_hat/(np.sqrt(v_hat)+1e-8)
+
+    def linesearch(self, hyperparams, grad, trainer):
+        # Backtracking gradient descent with the Armijo sufficient decrease
+        gp = trainer.gp
+        rate = self.state.get('rate', self.opt_rate)
+        cur_cost = gp.cur_cost
+        grad_norm2 = np.sum(grad**2)
+        direction = -grad/max(np.sqrt(grad_norm2), 1e-16)
+        for _ in range(self.max_backtracks):
+            new_hyperparams = hyperparams+rate*direction
+            gp.set_hyperparams(new_hyperparams)
+            cost = gp.get_cost()
+            if(cost <= cur_cost-self.armijo_c*rate*np.sqrt(grad_norm2)):
+                self.state['rate'] = rate/self.backtrack_rate
+                return new_hyperparams
+            rate *= self.backtrack_rate
+        self.state['rate'] = rate
+        return new_hyperparams
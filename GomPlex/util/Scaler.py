@@ -4,6 +4,7 @@
 ################################################################################
 
 import numpy as np
+from scipy import sparse
 
 __all__ = [
     "Scaler"
@@ -19,6 +20,10 @@ class Scaler(object):
     def __init__(self, scaler, matrix):
         assert scaler in self.scalers, "Invalid scaler!"
         self.scaler = scaler
+        if(sparse.issparse(matrix)):
+            assert scaler == 'minmax', "Sparse inputs only support minmax!"
+            self.sparse_minmax_init(matrix)
+            return
         getattr(self, self.scaler+'_init')(np.complex_(matrix)+0j)
 
     def eval(self, matrix, inv=False):
@@ -39,6 +44,15 @@ class Scaler(object):
                 self._i_max_ += .5
                 self._i_min_ -= .5
 
+    def sparse_minmax_init(self, matrix):
+        # Column ranges only, the implicit zeros count towards min and max
+        assert not np.iscomplexobj(matrix), "Sparse inputs must be real!"
+        self._r_min_ = matrix.min(axis=0).toarray().ravel().astype(np.float64)
+        self._r_max_ = matrix.max(axis=0).toarray().ravel().astype(np.float64)
+        if(np.any(self._r_min_ == self._r_max_)):
+            self._r_max_ += .5
+            self._r_min_ -= .5
+
     def minmax(self, matrix):
         res = (matrix.real-self._r_min_)/(self._r_max_-self._r_min_)-.5
         if(np.any(np.iscomplex(matrix))):
@@ -0,0 +1,84 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+import sys
+import json
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = [
+    "Telemetry"
+]
+
+class Telemetry(object):
+    
+    def __init__(self, callbacks=None, jsonl_path=None, ring_size=1000,
+        verbose=True, log_interval=1.):
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        self.jsonl_path = jsonl_path
+        self.records = deque(maxlen=ring_size)
+        self.verbose = verbose
+        self.log_interval = log_interval
+        self.reset()
+    
+    def reset(self):
+        self.phase_times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.last_phase_times, self.last_counters = {}, {}
+        self.last_emit_time, self.last_log_time = time.time(), 0.
+    
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+    
+    @contextmanager
+    def phase(self, name):
+        # Phases may nest, so each one reports inclusive wall time
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] += time.time()-start_time
+    
+    def count(self, name, num=1):
+        self.counters[name] += num
+    
+    def get_peak_memory(self):
+        if(resource is None):
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak*1024
+    
+    def emit(self, record, message=None, force=False):
+        now = time.time()
+        record = dict(record)
+        record['wall_time'] = now-self.last_emit_time
+        record['phase_times'] = {name:t-self.last_phase_times.get(name, 0.)
+            for name, t in self.phase_times.items()}
+        record['counters'] = {name:c-self.last_counters.get(name, 0)
+            for name, c in self.counters.items()}
+        record['peak_memory'] = self.get_peak_memory()
+        self.last_phase_times = dict(self.phase_times)
+        self.last_counters = dict(self.counters)
+        self.last_emit_time = now
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+        if(self.jsonl_path is not None):
+            with open(self.jsonl_path, 'a') as jsonl_f:
+                jsonl_f.write(json.dumps(record, default=float)+'\n')
+        # Rare events such as an interrupt bypass the log rate limit
+        if(self.verbose and (force or
+            now-self.last_log_time >= self.log_interval)):
+            self.last_log_time = now
+            print(message if message is not None else json.dumps(
+                record, default=float))
+            sys.stdout.flush()
+        return record
@@ -3,77 +3,216 @@
 #  Author: Max W. Y. Lam (maxingaussian@gmail.com)
 ################################################################################
 
-import sys
+import os
+import time
+import pickle
 import numpy as np
+from scipy.optimize import minimize
+
+from .Optimizer import Optimizer
 
 __all__ = [
     "Trainer"
 ]
 
+class StopTraining(Exception):
+    pass
+
 class Trainer(object):
     
-    def __init__(self, gp, opt_rate, max_iter, iter_tol, diff_tol, early_stop):
+    def __init__(self, gp, opt_rate, max_iter, iter_tol, diff_tol, early_stop,
+        optimizer='adaptive', time_budget=None, checkpoint_path=None,
+        checkpoint_every=10, monitor=None, monitor_every=10):
         self.gp = gp
         self.opt_rate = opt_rate
         self.max_iter = max_iter
         self.iter_tol = iter_tol
         self.diff_tol = diff_tol
         self.early_stop = early_stop
+        self.time_budget = time_budget
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.monitor = monitor
+        self.monitor_every = monitor_every
+        self.fidelity_tol = max(iter_tol//3, 1)
+        if(isinstance(optimizer, Optimizer)):
+            self.optimizer = optimizer
+        else:
+            self.optimizer = Optimizer(optimizer, opt_rate)
 
-    def train(self, animate=None):
+    def train(self, animate=None, resume_from=None):
         self.learned_hyperparams = None
         self.iter, self.div_count, self.min_cost = 0, 0, np.Infinity
-        N = self.gp.N
+        self.restart, self.stopped = False, False
+        self.last_hyperparams, self.random_state = None, None
         self.cost_records, self.min_cost_records = [], []
-        while(True):
+        self.gp.telemetry.reset()
+        if(resume_from is not None):
+            self.load_checkpoint(resume_from)
+        self.start_time = time.time()
+        freqs_update_rate = self.gp.freqs_update_rate
+        if(self.optimizer.optimizer in self.optimizer.full_grad_optimizers):
+            # Probe every frequency instead of a random subset each call
+            assert self.gp.grad_estimator == 'coordinate',\
+                "%s needs the coordinate gradient!"%(self.optimizer.optimizer)
+            self.gp.freqs_update_rate = 1.
+        try:
+            if(self.optimizer.optimizer == 'lbfgs'):
+                self.train_lbfgs(animate)
+            else:
+                while(not self.stop_condition()):
+                    grad = self.gp.get_cost_grad()
+                    hyperparams = self.gp.get_hyperparams()
+                    if(self.restart):
+                        hyperparams = self.learned_hyperparams.copy()
+                    hyperparams = self.optimizer.update(hyperparams, grad, self)
+                    self.gp.set_hyperparams(hyperparams)
+                    self.record(hyperparams, animate)
+        except KeyboardInterrupt:
+            # Best hyperparameters and checkpoint are kept, then the caller
+            # gets the interrupt so that outer loops stop too
+            self.gp.telemetry.emit({'iter':self.iter, 'interrupted':True},
+                "  interrupted - keeping best hyperparameters so far", True)
+            self.finish(freqs_update_rate)
+            raise
+        self.finish(freqs_update_rate)
+    
+    def finish(self, freqs_update_rate):
+        self.gp.freqs_update_rate = freqs_update_rate
+        if(self.checkpoint_path is not None):
+            self.save_checkpoint(self.checkpoint_path)
+        if(self.gp.fidelity < 1):
+            self.gp.set_fidelity(1.)
+        if(self.learned_hyperparams is not None):
+            self.gp.set_hyperparams(self.learned_hyperparams)
+    
+    def train_lbfgs(self, animate):
+        def cost_grad(hyperparams):
+            self.gp.set_hyperparams(hyperparams)
             grad = self.gp.get_cost_grad()
-            hyperparams = self.gp.get_hyperparams()
-            if(self.div_count % self.iter_tol//2 == self.iter_tol//4):
-                hyperparams = self.learned_hyperparams.copy()
-            hyperparams = self.apply_update_rule(hyperparams, grad)
+            return self.gp.cur_cost, grad
+        def callback(hyperparams):
             self.gp.set_hyperparams(hyperparams)
-            self.iter += 1
-            if(animate is not None):
-                animate(self)
-            cost = self.gp.get_cost()
-            self.cost_records.append(cost)
-            print("  iter %d - best %.8f - update %.8f - %d/%d"%(
-                self.iter, self.min_cost, cost, self.div_count, self.iter_tol))
-            sys.stdout.flush()
-            if(np.mean(self.cost_records[-self.early_stop:]) > 
-                np.mean(self.min_cost_records[-self.early_stop//2:]) and
-                    self.iter > self.early_stop):
-                self.div_count += 1
-            if(cost < self.min_cost):
-                if(self.min_cost-cost > self.diff_tol):
-                    self.div_count = 0
-                else:
-                    self.div_count += 1
-                self.min_cost = cost
-                self.min_cost_records.append(cost)
-                self.learned_hyperparams = hyperparams.copy()
+            if(self.record(hyperparams.copy(), animate)):
+                raise StopTraining
+        try:
+            minimize(cost_grad, self.gp.get_hyperparams(), jac=True,
+                method='L-BFGS-B', callback=callback,
+                options={'maxiter':self.max_iter})
+        except StopTraining:
+            pass
+    
+    def record(self, hyperparams, animate=None):
+        self.iter += 1
+        if(animate is not None):
+            animate(self)
+        cost = self.gp.get_cost()
+        self.cost_records.append(cost)
+        step_norm = 0. if self.last_hyperparams is None else\
+            np.linalg.norm(hyperparams-self.last_hyperparams)
+        self.last_hyperparams = hyperparams.copy()
+        self.gp.telemetry.emit({
+            'iter':self.iter,
+            'cost':float(np.real(cost)),
+            'best_cost':float(np.real(self.min_cost)),
+            'step_norm':float(step_norm),
+            'div_count':self.div_count,
+            'elapsed':time.time()-self.start_time,
+        }, "  iter %d - best %.8f - update %.8f - %d/%d"%(
+            self.iter, self.min_cost, cost, self.div_count, self.iter_tol))
+        last_div_count = self.div_count
+        if(self.iter > self.early_stop and len(self.min_cost_records) > 0 and
+            np.mean(self.cost_records[-self.early_stop:]) > 
+                np.mean(self.min_cost_records[-self.early_stop//2:])):
+            self.div_count += 1
+        if(cost < self.min_cost):
+            if(self.min_cost-cost > self.diff_tol):
+                self.div_count = 0
             else:
                 self.div_count += 1
-            if(self.stop_condition()):
-                self.gp.set_hyperparams(self.learned_hyperparams)
-                break
+            self.min_cost = cost
+            self.min_cost_records.append(cost)
+            self.learned_hyperparams = hyperparams.copy()
+        else:
+            self.div_count += 1
+        if(self.gp.fidelity < 1 and self.div_count >= self.fidelity_tol):
+            self.increase_fidelity()
+        # Restart from the best hyperparameters once a plateau is half tolerated
+        self.restart = self.learned_hyperparams is not None and\
+            last_div_count < self.iter_tol//2 <= self.div_count
+        self.random_state = np.random.get_state()
+        if(self.checkpoint_path is not None and
+            self.iter % self.checkpoint_every == 0):
+            self.save_checkpoint(self.checkpoint_path)
+        # A monitor returning True ends the search, e.g. on a drifted objective
+        if(self.monitor is not None and self.iter % self.monitor_every == 0):
+            self.stopped = bool(self.monitor(self))
+        return self.stop_condition()
+    
+    def increase_fidelity(self):
+        # Costs on a larger subset are not comparable, so restart the tracking
+        self.gp.set_fidelity(self.gp.fidelity*self.gp.subsample_growth)
+        self.min_cost, self.div_count = np.Infinity, 0
+        self.cost_records, self.min_cost_records = [], []
+    
+    def save_checkpoint(self, path):
+        # State as of the last recorded iteration: an interrupt may land in
+        # the middle of probes that perturb the model and draw random numbers,
+        # and gp.get_hyperparams() would round-trip through exp and log
+        hyperparams = self.gp.get_hyperparams() if self.last_hyperparams\
+            is None else self.last_hyperparams
+        random_state = np.random.get_state() if self.random_state is None\
+            else self.random_state
+        save_pack = {
+            'hyperparams':hyperparams,
+            'learned_hyperparams':self.learned_hyperparams,
+            'optimizer':self.optimizer.optimizer,
+            'optimizer_state':self.optimizer.state,
+            'iter':self.iter,
+            'div_count':self.div_count,
+            'min_cost':self.min_cost,
+            'restart':self.restart,
+            'cost_records':self.cost_records,
+            'min_cost_records':self.min_cost_records,
+            'fidelity':self.gp.fidelity,
+            'subsample_index':self.gp.subsample_index,
+            'random_state':random_state,
+        }
+        if(self.gp.fastfood):
+            # Signs and permutations are fixed, only G and S are hyperparams
+            save_pack['fastfood_B'] = self.gp.fastfood_op.B
+            save_pack['fastfood_P'] = self.gp.fastfood_op.P
+        # Write then rename so a preempted job never leaves a torn checkpoint
+        with open(path+'.tmp', 'wb') as save_f:
+            pickle.dump(save_pack, save_f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path+'.tmp', path)
+    
+    def load_checkpoint(self, path):
+        with open(path, 'rb') as load_f:
+            load_pack = pickle.load(load_f)
+        assert load_pack['optimizer'] == self.optimizer.optimizer,\
+            "Checkpoint was saved with a different optimizer!"
+        if('fastfood_B' in load_pack):
+            self.gp.fastfood_op.B = load_pack['fastfood_B']
+            self.gp.fastfood_op.P = load_pack['fastfood_P']
+        self.gp.set_fidelity(load_pack['fidelity'], load_pack['subsample_index'])
+        self.gp.set_hyperparams(load_pack['hyperparams'])
+        self.last_hyperparams = load_pack['hyperparams'].copy()
+        self.learned_hyperparams = load_pack['learned_hyperparams']
+        self.optimizer.state = load_pack['optimizer_state']
+        self.iter = load_pack['iter']
+        self.div_count = load_pack['div_count']
+        self.min_cost = load_pack['min_cost']
+        self.restart = load_pack['restart']
+        self.cost_records = load_pack['cost_records']
+        self.min_cost_records = load_pack['min_cost_records']
+        self.random_state = load_pack['random_state']
+        np.random.set_state(self.random_state)
     
     def stop_condition(self):
-        if(self.iter >= self.max_iter or self.div_count >= self.iter_tol):
+        if(self.stopped or self.iter >= self.max_iter or self.div_count >= self.iter_tol):
+            return True
+        if(self.time_budget is not None and
+            time.time()-self.start_time >= self.time_budget):
             return True
         return False
-
-    def apply_update_rule(self, hyperparams, grad):
-        if('mem' not in self.__dict__.keys()):
-            self.mem = np.ones(hyperparams.shape)
-            self.g = np.zeros(hyperparams.shape)
-            self.g2 = np.zeros(hyperparams.shape)
-        r = 1/(self.mem+1)
-        self.g = (1-r)*self.g+r*grad
-        self.g2 = (1-r)*self.g2+r*grad**2
-        rate1 = self.g*self.g/(self.g2+1e-16)
-        self.mem *= 1-rate1
-        rate2 = self.opt_rate/(max(self.div_count, 7))
-        self.mem += 1
-        self.rate = np.minimum(rate1, rate2)/(np.sqrt(self.g2)+1e-16)
-        return hyperparams-grad*self.rate
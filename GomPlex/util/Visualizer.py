@@ -3,93 +3,160 @@
 #  Author: Max W. Y. Lam (maxingaussian@gmail.com)
 ################################################################################
 
+import os
+import copy
+import time
+import threading
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.mplot3d import Axes3D
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 __all__ = [
     "Visualizer"
 ]
 
 class Visualizer(object):
-    
-    def __init__(self, gp, metric='nmse', plot_limit=150):
+
+    def __init__(self, gp, metric='nmse', plot_limit=150, max_fps=5,
+        render_budget=0.05, frame_dir=None):
         self.gp = gp
         self.metric = metric
         self.plot_limit = plot_limit
-    
+        self.max_fps = max_fps
+        self.render_budget = render_budget
+        self.frame_dir = frame_dir
+        self.render_thread = None
+
     def plot_training(self):
+        self.history = []
+        self.last_render_time, self.render_wait = 0., 0.
+        if(self.frame_dir is not None):
+            # Offline frames are drawn on a non-GUI canvas by a worker thread
+            if(not os.path.exists(self.frame_dir)):
+                os.makedirs(self.frame_dir)
+            self.fig = Figure()
+            FigureCanvasAgg(self.fig)
+            self.frame_count = 0
+            self.snapshots = queue.Queue(maxsize=1)
+            self.render_thread = threading.Thread(target=self.render_loop)
+            self.render_thread.daemon = True
+            self.render_thread.start()
+            return self.publish
         self.fig = plt.figure(1)
         if(self.gp.D == 1):
             plt.axis('off')
-            return self.plot_training_1d()
-        return self.plot_training_general()
-    
-    def plot_training_1d(self):
-        ax1 = self.fig.add_subplot(211)
-        ax2 = self.fig.add_subplot(212)
-        def animate(trainer):
-            pts = 200
-            X_plot = np.linspace(-0.5, 0.5, pts)
-            mu, std = self.gp.predict(X_plot[:, None], scaled=False)
-            ax1.cla()
-            errors = [0.25, 0.39, 0.52, 0.67, 0.84, 1.04, 1.28, 1.64, 2.2]
-            for er in errors:
-                ax1.fill_between(X_plot,
-                    (mu.real-er*std.real).ravel(),
-                    (mu.real+er*std.real).ravel(),
-                    alpha=((2.9-er)/6)**1.9, facecolor='orange',
-                    linewidth=1e-3)
-            ax1.plot(X_plot, mu.real.ravel(), 'r-',
-                linewidth=2, label=self.gp.__str__())
-            ax1.scatter(self.gp.X[:, 0], self.gp.y.real.ravel(),
-                marker='x', s=30, label='training data')
-            ax1.set_xlim([-.5, .5])
-            ax1.set_ylim([-3.5, 3.5])
-            ax1.set_ylabel('Re{y}')
-            ax1.set_title('Real-time Plot of Complex Regression (Real Part)')
-            ax2.cla()
-            for er in errors:
-                ax2.fill_between(X_plot,
-                    (mu.imag-er*std.imag).ravel(),
-                    (mu.imag+er*std.imag).ravel(),
-                    alpha=((2.9-er)/6)**1.9, facecolor='orange',
-                    linewidth=1e-3)
-            ax2.plot(X_plot, mu.imag.ravel(), 'r-',
-                linewidth=2, label=self.gp.__str__())
-            ax2.scatter(self.gp.X[:, 0], self.gp.y.imag.ravel(),
-                marker='x', s=30, label='training data')
-            ax2.set_xlim([-.5, .5])
-            ax2.set_ylim([-3.5, 3.5])
-            ax2.set_ylabel('Im{y}')
-            ax2.set_title('Real-time Plot of Complex Regression (Imaginary Part)')
-            plt.xlabel('x', fontsize=13)
-            self.fig.subplots_adjust(hspace=0.3)
-            plt.pause(0.01)
-        return animate
+        return self.animate
 
-    def plot_training_general(self):
-        self.fig.suptitle(self.gp.__str__(), fontsize=15)
-        ax = self.fig.add_subplot(111)
-        def animate(trainer):
-            if(trainer.iter == 1):
-                data_x, data_y = [], []
-            else:
-                data_x = ax.lines[0].get_xdata().tolist()
-                data_y = ax.lines[0].get_ydata().tolist()
-            data_x.append(trainer.iter)
-            data_y.append(self.gp.cur_cost)
-            ax.cla()
-            ax.plot(data_x[-self.plot_limit:], data_y[-self.plot_limit:],
-                color='r', linewidth=2.0, label='COST')
-            handles, labels = ax.get_legend_handles_labels()
-            ax.set_ylabel(self.gp.cost_type, fontsize=13)
-            ax.set_xlabel('Number of iterations', fontsize=13)
-            plt.pause(0.01)
-        return animate
+    def stop(self):
+        if(self.render_thread is not None):
+            self.snapshots.put(None)
+            self.render_thread.join()
+            self.render_thread = None
+
+    def take_snapshot(self, trainer):
+        # Only state that Trainer reassigns is shared, mutable arrays are copied
+        self.history.append((trainer.iter, self.gp.cur_cost))
+        snapshot = copy.copy(self.gp)
+        snapshot.spectral_freqs = self.gp.spectral_freqs.copy()
+        return snapshot, list(self.history[-self.plot_limit:])
 
+    def render_due(self):
+        # Throttle to max_fps and keep drawing under render_budget of the time
+        now = time.time()
+        return now-self.last_render_time >= max(
+            1./self.max_fps, self.render_wait)
 
+    def render(self, snapshot, history):
+        self.fig.clf()
+        if(snapshot.D == 1):
+            self.draw_training_1d(snapshot)
+        else:
+            self.draw_training_general(snapshot, history)
 
+    def throttle(self, start_time):
+        self.last_render_time = time.time()
+        self.render_wait = (self.last_render_time-start_time)/self.render_budget
 
+    def animate(self, trainer):
+        if(not self.render_due()):
+            self.history.append((trainer.iter, self.gp.cur_cost))
+            return
+        start_time = time.time()
+        self.render(*self.take_snapshot(trainer))
+        plt.pause(0.001)
+        self.throttle(start_time)
 
+    def publish(self, trainer):
+        if(not self.snapshots.empty() or not self.render_due()):
+            self.history.append((trainer.iter, self.gp.cur_cost))
+            return
+        try:
+            self.snapshots.put_nowait(self.take_snapshot(trainer))
+        except queue.Full:
+            pass
+
+    def render_loop(self):
+        while(True):
+            snapshot = self.snapshots.get()
+            if(snapshot is None):
+                break
+            start_time = time.time()
+            self.render(*snapshot)
+            self.fig.savefig(os.path.join(self.frame_dir,
+                'frame_%05d.png'%(self.frame_count)))
+            self.frame_count += 1
+            self.throttle(start_time)
+
+    def draw_training_1d(self, gp):
+        ax1 = self.fig.add_subplot(211)
+        ax2 = self.fig.add_subplot(212)
+        pts = 200
+        X_plot = np.linspace(-0.5, 0.5, pts)
+        mu, std = gp.predict(X_plot[:, None], scaled=False)
+        errors = [0.25, 0.39, 0.52, 0.67, 0.84, 1.04, 1.28, 1.64, 2.2]
+        for er in errors:
+            ax1.fill_between(X_plot,
+                (mu.real-er*std.real).ravel(),
+                (mu.real+er*std.real).ravel(),
+                alpha=((2.9-er)/6)**1.9, facecolor='orange',
+                linewidth=1e-3)
+        ax1.plot(X_plot, mu.real.ravel(), 'r-',
+            linewidth=2, label=gp.__str__())
+        ax1.scatter(gp.X[:, 0].real, gp.y.real.ravel(),
+            marker='x', s=30, label='training data')
+        ax1.set_xlim([-.5, .5])
+        ax1.set_ylim([-3.5, 3.5])
+        ax1.set_ylabel('Re{y}')
+        ax1.set_title('Real-time Plot of Complex Regression (Real Part)')
+        for er in errors:
+            ax2.fill_between(X_plot,
+                (mu.imag-er*std.imag).ravel(),
+                (mu.imag+er*std.imag).ravel(),
+                alpha=((2.9-er)/6)**1.9, facecolor='orange',
+                linewidth=1e-3)
+        ax2.plot(X_plot, mu.imag.ravel(), 'r-',
+            linewidth=2, label=gp.__str__())
+        ax2.scatter(gp.X[:, 0].real, gp.y.imag.ravel(),
+            marker='x', s=30, label='training data')
+        ax2.set_xlim([-.5, .5])
+        ax2.set_ylim([-3.5, 3.5])
+        ax2.set_ylabel('Im{y}')
+        ax2.set_title('Real-time Plot of Complex Regression (Imaginary Part)')
+        ax2.set_xlabel('x', fontsize=13)
+        self.fig.subplots_adjust(hspace=0.3)
+
+    def draw_training_general(self, gp, history):
+        self.fig.suptitle(gp.__str__(), fontsize=15)
+        ax = self.fig.add_subplot(111)
+        data_x, data_y = zip(*history)
+        ax.plot(data_x, np.real(data_y),
+            color='r', linewidth=2.0, label='COST')
+        ax.set_ylabel(gp.cost_type, fontsize=13)
+        ax.set_xlabel('Number of iterations', fontsize=13)
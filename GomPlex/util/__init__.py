@@ -6,5 +6,9 @@
 from .Metric import *
 from .Linalg import *
 from .Scaler import *
+from .Chunker import *
+from .Coreset import *
+from .Optimizer import *
+from .Telemetry import *
 from .Trainer import *
 from .Visualizer import *
@@ -264,10 +264,9 @@ class DecisionSystem(object):
         except:
             print(subject)
             return None
-        X_ci, X_nci = X.copy(), X.copy()
-        X_ci[:, 0], X_nci[:, 0] = 1, 0
-        mu_ci, std_ci = model.predict(X_ci)
-        mu_nci, std_nci = model.predict(X_nci)
+        mus, stds = model.predict_counterfactual(X, 0, [1, 0])
+        mu_ci, mu_nci = mus
+        std_ci, std_nci = stds
         return X[0, 0], y, mu_ci, std_ci, mu_nci, std_nci
     
     def show_predicted_drawing(self, X, y, y_ci, y_nci):
@@ -297,7 +296,7 @@ class DecisionSystem(object):
             print('# Training GomPlex')
             gp = GomPlex(npr.randint(int(np.log(X_train.shape[0]))*2)+8, True)
             gp.fit(X_train, y_train, iter_tol=iter_tol,
-                cv_folds=cv_folds, plot=plot_error)
+                cv_folds=cv_folds, plot=plot_error, aggregate_duplicates=True)
             print('  Done.')
             print('# Choosing GomPlex Models')
             score = self.eval_model_for_subjects(model=gp)[0]
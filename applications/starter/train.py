@@ -122,9 +122,10 @@ while (True):
     
             print("Start prediction ...")
             test_dates = [288, 319, 349, 653, 684, 714]
-            for i, test_date in enumerate(test_dates):
-                X_test[:, -1] = test_date
-                y_test = gp.predict(X_test)[0].ravel()
+            y_tests = gp.predict_counterfactual(X_test, -1, test_dates,
+                return_std=False)[0]
+            for i, y_test in enumerate(y_tests):
+                y_test = y_test.ravel()
                 result[result.columns[i+1]] = y_test.real-y_test.imag
             
             print("Start write result ...")
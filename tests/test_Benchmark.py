@@ -0,0 +1,265 @@
+################################################################################
+#  Github: https://github.com/MaxInGaussian/GomPlex
+#  Author: Max W. Y. Lam (maxingaussian@gmail.com)
+################################################################################
+
+from sys import path
+path.append("../")
+import os
+import time
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+
+from GomPlex import *
+
+N, D, M = 500, 3, 20
+X = np.random.rand(N, D)
+W = np.random.randn(D, 5)*3
+f = np.exp(2j*np.pi*X.dot(W)).dot(np.random.randn(5)+1j*np.random.randn(5))
+y = (f+(np.random.randn(N)+1j*np.random.randn(N))*0.1)[:, None]
+
+def run(**fit_args):
+    np.random.seed(0)
+    gp = GomPlex(M)
+    gp.telemetry.verbose = False
+    costs = []
+    gp.telemetry.add_callback(
+        lambda record: costs.append(record['cost']) if 'iter' in record else 0)
+    start_time = time.time()
+    gp.fit(X, y, max_iter=200, iter_tol=30, **fit_args)
+    return costs, time.time()-start_time
+
+print()
+print('test of init strategies')
+results = {init:run(init=init) for init in GomPlex.init_strategies}
+target_cost = 1.05*np.max([np.min(costs) for costs, _ in results.values()])
+for init, (costs, fit_time) in results.items():
+    hits = np.where(np.array(costs) <= target_cost)[0]
+    print('%12s - first cost %.4f - best %.4f - iters to %.4f: %s - time %.2fs'%(
+        init, costs[0], np.min(costs), target_cost,
+        hits[0]+1 if len(hits) else '-', fit_time))
+
+print()
+print('test of GomPlexBatch')
+sparsities = [5, 8, 10, 12]*4
+start_time = time.time()
+batch = GomPlexBatch(sparsities, seeds=range(len(sparsities)))
+batch.telemetry.verbose = False
+batch.fit(X, y, max_iter=30, iter_tol=1000)
+batch_time = time.time()-start_time
+start_time = time.time()
+for seed, sparsity in enumerate(sparsities):
+    np.random.seed(seed)
+    gp = GomPlex(sparsity)
+    gp.telemetry.verbose = False
+    gp.fit(X, y, max_iter=30, iter_tol=1000, early_stop=1000)
+serial_time = time.time()-start_time
+print('batched %d models: %.2fs, serial: %.2fs'%(
+    len(sparsities), batch_time, serial_time))
+gp = batch.get_models()[0]
+mu, std = batch.predict(X[:10])
+print('unstacked model max error:', np.max(np.abs(gp.predict(X[:10])[0]-mu[0])))
+real_batch = GomPlexBatch([5, 8], seeds=[0, 1])
+real_batch.telemetry.verbose = False
+real_batch.fit(X, y.real, cost_type='nmse', max_iter=10)
+mu, std = real_batch.predict(X[:10])
+print('real targets - nmse', real_batch.min_cost, '- real mean:',
+    not np.iscomplexobj(mu))
+
+print()
+print('test of GomPlexEnsemble')
+ensemble = GomPlexEnsemble(6, M, feature_ratio=.67).fit(X, y, max_iter=30)
+X_test = np.random.rand(100000, D)
+start_time = time.time()
+mu, std = ensemble.predict(X_test, return_std=False)
+fused_time = time.time()-start_time
+start_time = time.time()
+mus = [gp.predict(X_test[:, feats], return_std=False)[0]
+    for gp, feats in zip(ensemble.models, ensemble.feature_indices)]
+loop_time = time.time()-start_time
+print('fused predict: %.2fs, per-member predict: %.2fs'%(fused_time, loop_time))
+print('fused mean max error:', np.max(np.abs(np.mean(mus, 0)-mu)))
+
+print()
+print('test of predict_fast')
+gp = ensemble.models[0]
+X_test = np.random.rand(100000, len(ensemble.feature_indices[0]))
+X_test.flags.writeable = False
+mu_out = np.empty((X_test.shape[0], 1), dtype=np.complex128)
+std_out = np.empty((X_test.shape[0], 1), dtype=np.complex128)
+start_time = time.time()
+mu, std = gp.predict(X_test)
+predict_time = time.time()-start_time
+start_time = time.time()
+gp.predict_fast(X_test, mu_out, std_out)
+fast_time = time.time()-start_time
+print('predict: %.2fs, predict_fast: %.2fs'%(predict_time, fast_time))
+print('predict_fast max error:', np.max(np.abs(mu-mu_out)),
+    np.max(np.abs(std-std_out)))
+
+print()
+print('test of predict_to')
+np.save('X_test.npy', X_test)
+start_time = time.time()
+rows = gp.predict_to('y_test.npy', 'X_test.npy', chunk_size=10000)
+print('streamed %d rows: %.2fs'%(rows, time.time()-start_time))
+print('streamed max error:', np.max(np.abs(np.load('y_test.npy')[:, :1]-mu)))
+chunks = gp.predict_iter(X_test, chunk_size=1000, prefetch=2)
+next(chunks)
+start_time = time.time()
+chunks.close()
+print('early stop of predict_iter: %.2fs'%(time.time()-start_time))
+os.remove('X_test.npy')
+os.remove('y_test.npy')
+
+print()
+print('test of sparse inputs')
+from scipy import sparse
+X_onehot = np.hstack((X, np.eye(50)[np.random.randint(50, size=(N, 20))].reshape(N, -1)))
+gp_dense, gp_sparse = GomPlex(M), GomPlex(M)
+for gp, X_fit in [(gp_dense, X_onehot), (gp_sparse, sparse.csr_matrix(X_onehot))]:
+    gp.telemetry.verbose = False
+    gp.fit(X_fit, y, max_iter=1)
+gp_sparse.set_hyperparams(gp_dense.get_hyperparams())
+for name, gp in [('dense', gp_dense), ('sparse', gp_sparse)]:
+    gp.clear_cache()
+    start_time = time.time()
+    cost = gp.get_cv_metric(3, 'nlml')
+    print('%6s cost %.6f - 3-fold cv time %.3fs'%(name, cost, time.time()-start_time))
+
+print()
+print('test of Fastfood frequencies')
+X_wide = np.hstack((X, np.random.rand(N, 60)))
+for fastfood in [False, True]:
+    np.random.seed(0)
+    gp = GomPlex(M, fastfood=fastfood)
+    gp.telemetry.verbose = False
+    start_time = time.time()
+    gp.fit(X_wide, y, max_iter=30)
+    print('fastfood=%s - %d hyperparameters - cost %.4f - time %.2fs'%(
+        fastfood, gp.get_hyperparams_size(), gp.get_cost(), time.time()-start_time))
+
+print()
+print('test of real-output fast path')
+X_real = np.random.rand(2000, D)
+y_real = (np.sin(6*X_real[:, 0])+np.random.randn(2000)*0.1)[:, None]
+gp = GomPlex(100)
+gp.telemetry.verbose = False
+gp.fit(X_real, y_real, max_iter=1)
+for real_output in [False, True]:
+    gp.real_output = real_output
+    gp.clear_cache()
+    start_time = time.time()
+    for _ in range(10):
+        gp.clear_cache()
+        gp.train()
+    print('real_output=%s - train time %.4fs'%(real_output, (time.time()-start_time)/10))
+mu, std = gp.predict(X_real)
+mu_fast, std_fast = gp.predict_fast(X_real)
+print('real-output predict_fast max error:', np.max(np.abs(mu-mu_fast)),
+    np.max(np.abs(std-std_fast)))
+print('real-output prune:', gp.prune(target_M=50))
+gp = GomPlex(10)
+gp.telemetry.verbose = False
+gp.fit(X_real, y_real, max_iter=1, grow_basis=30)
+print('real-output grow: M=%d - cost %.4f'%(gp.M, gp.get_cost()))
+
+print()
+print('test of duplicate-row aggregation')
+X_dup = np.random.rand(200, D)[np.random.randint(200, size=20000)]
+y_dup = np.exp(2j*np.pi*X_dup.dot(W)).dot(np.random.randn(5))[:, None]
+gp = GomPlex(50)
+gp.telemetry.verbose = False
+gp.fit(X_dup, y_dup, max_iter=1)
+for aggregate_duplicates in [False, True]:
+    gp.aggregate_duplicates = aggregate_duplicates
+    gp.clear_cache()
+    start_time = time.time()
+    cost = gp.get_cost()
+    print('aggregate_duplicates=%s - cost %.10f - time %.4fs'%(
+        aggregate_duplicates, cost, time.time()-start_time))
+
+print()
+print('test of coreset fitting')
+X_big = np.random.rand(20000, D)
+y_big = np.exp(2j*np.pi*X_big.dot(W)).dot(np.random.randn(5))[:, None]
+for coreset in [None, Coreset('leverage', 500), Coreset('kmeans', 500)]:
+    np.random.seed(0)
+    gp = GomPlex(M)
+    gp.telemetry.verbose = False
+    start_time = time.time()
+    gp.fit(X_big, y_big, max_iter=30, coreset=coreset)
+    report = gp.coreset_report or {'size':20000, 'max_error':0.}
+    print('%8s - %5d rows - cost %.4f - discrepancy %.4f - time %.2fs'%(
+        coreset and coreset.method, report['size'], gp.get_cost(),
+        report['max_error'], time.time()-start_time))
+    assert coreset is None or report['max_error'] <= coreset.tol
+
+print()
+print('test of lattice predictive std')
+X_1d = np.random.rand(2000, 1)
+y_1d = np.sin(12*X_1d)+1j*np.cos(7*X_1d)+.1*np.random.randn(2000, 1)
+gp = GomPlex(200, freqs_lattice=True)
+gp.telemetry.verbose = False
+gp.fit(X_1d, y_1d, max_iter=3)
+X_test = np.random.rand(200, 1)
+start_time = time.time()
+mu, std = gp.predict(X_test)
+predict_time = time.time()-start_time
+Phi = np.sqrt(gp.kernel_scale/gp.M)*np.exp(
+    -2j*np.pi*gp.X_scaler.eval(X_test).dot(gp.spectral_freqs))
+Phi_inv_A_Phi_H = np.sum(Phi*np.linalg.solve(
+    gp.T.to_dense(), Phi.conj().T).T, 1)
+exact_std = gp.get_y_std_scale()*np.sqrt(
+    (gp.noise_real+gp.noise_imag*1j)*(1+Phi_inv_A_Phi_H))[:, None]
+print('circulant std relative error %.4f - predict %.4fs'%(
+    np.max(np.abs(std-exact_std)/np.abs(exact_std)), predict_time))
+gp.fit(X_1d, y_1d.real, max_iter=3)
+mu, std = gp.predict(X_test)
+print('lattice real targets - real mean:', not np.iscomplexobj(mu))
+
+print()
+print('test of dual solver against primal')
+gp = GomPlex(60)
+gp.telemetry.verbose = False
+gp.fit(X[:30], y[:30], max_iter=3)
+mu_dual, std_dual = gp.predict(X[:50])
+alpha_dual, log_det_dual = gp.alpha.copy(), gp.log_det_A
+gp.train_primal()
+mu_primal, std_primal = gp.predict(X[:50])
+print('dual %s - alpha %.2e - std %.2e - log_det_A %.2e'%(
+    gp.inv_K is not None, np.max(np.abs(gp.alpha-alpha_dual)),
+    np.max(np.abs(std_primal-std_dual)), np.abs(gp.log_det_A-log_det_dual)))
+
+print()
+print('test of counterfactual prediction against per-scenario predict')
+values = [.2, .5, .8]
+for name, sparsity, rows, targets in [('complex', M, N, y),
+    ('real', M, N, y.real), ('dual', 60, 30, y), ('real dual', 60, 30, y.real)]:
+    gp = GomPlex(sparsity)
+    gp.telemetry.verbose = False
+    gp.fit(X[:rows], targets[:rows], max_iter=3)
+    mus, stds = gp.predict_counterfactual(X[:50], 1, values)
+    mu_error, std_error = 0., 0.
+    for k, value in enumerate(values):
+        X_k = X[:50].copy()
+        X_k[:, 1] = value
+        mu, std = gp.predict(X_k)
+        mu_error = max(mu_error, np.max(np.abs(mus[k]-mu)))
+        std_error = max(std_error, np.max(np.abs(stds[k]-std)))
+    print('%9s - mean error %.2e - std error %.2e'%(name, mu_error, std_error))
+
+print()
+print('test of frequency gradient estimators')
+for grad_estimator, grad_directions in [('coordinate', 1), ('spsa', 1),
+    ('spsa', 4), ('random', 4)]:
+    np.random.seed(0)
+    gp = GomPlex(M)
+    gp.telemetry.verbose = False
+    start_time = time.time()
+    gp.fit(X, y, max_iter=30, grad_estimator=grad_estimator,
+        grad_directions=grad_directions)
+    print('%10s x%d - cost %.4f - train calls %d - time %.2fs'%(
+        grad_estimator, grad_directions, gp.get_cost(),
+        gp.telemetry.counters['train_calls'], time.time()-start_time))
@@ -118,10 +118,63 @@ print('numpy needs   ', timer.timeit(time_reps)/time_reps, 's')
 timer = Timer(lambda:solve_A_algo_2(y, x, M, noise))
 print('our algo needs', timer.timeit(time_reps)/time_reps, 's')
 
+print()
+print('test of ToeplitzOperator.solve')
+k = -(M//2)+np.arange(M)
+Phi = np.exp(-2j*np.pi*k*X[:, 0][:, None])
+A = Phi.conj().T.dot(Phi)+noise*N*np.eye(M)
+T = ToeplitzOperator(A[:, 0])
+B = np.random.randn(M, K)+0j
+sol_true = linalg.solve(A, B)
+sol_fast = T.solve(B)
+print('approx l0 error:', np.max(np.abs(sol_true-sol_fast)))
+print('approx l1 error:', np.mean(np.abs(sol_true-sol_fast)))
+print('approx l2 error:', np.sqrt(np.mean(np.abs(sol_true-sol_fast)**2)))
+timer = Timer(lambda:linalg.solve(A, B))
+print('numpy needs   ', timer.timeit(time_reps)/time_reps, 's')
+timer = Timer(lambda:T.solve(B))
+print('our algo needs', timer.timeit(time_reps)/time_reps, 's')
 
+print()
+print('test of tune_nfft')
+plan = tune_nfft(N*K, M, cache_path=None)
+print('tuned plan:', plan)
+print('measured error:', plan.error, '- error bound:', plan.error_bound)
+f_tuned = plan.forward(x, f_hat)
+print('approx l0 error:', np.max(np.abs(f_true-f_tuned)))
+timer = Timer(lambda:nfft(x, f_hat, M))
+print('default needs ', timer.timeit(time_reps)/time_reps, 's')
+timer = Timer(lambda:plan.forward(x, f_hat))
+print('tuned needs   ', timer.timeit(time_reps)/time_reps, 's')
 
+print()
+print('test of FastfoodOperator')
+F = FastfoodOperator(D, M).init_diagonals()
+W = F.to_dense()
+print('fwht l0 error:', np.max(np.abs(fwht(X[:, :16])-X[:, :16].dot(linalg.hadamard(16)))))
+print('approx l0 error:', np.max(np.abs(F.matvec(X)-X.dot(W))))
+print('mean squared frequency:', np.mean(W**2))
+timer = Timer(lambda:X.dot(W))
+print('numpy needs   ', timer.timeit(time_reps)/time_reps, 's')
+timer = Timer(lambda:F.matvec(X))
+print('our algo needs', timer.timeit(time_reps)/time_reps, 's')
 
-
-
-
-
+print()
+print('test of blocked_gram')
+W = np.random.randn(D, M)
+project = lambda X_tile:X_tile.dot(W)
+y = np.random.randn(N, 1)+1j*np.random.randn(N, 1)
+Phi = np.exp(-2j*np.pi*project(X))
+G, Phi_H_y = blocked_gram(X, project, y, M, tile_size=256)
+print('approx l0 error:', np.max(np.abs(G-Phi.conj().T.dot(Phi))))
+print('Phi^H y l0 error:', np.max(np.abs(Phi_H_y-Phi.conj().T.dot(y))))
+X_complex = X+.01j*np.random.rand(N, D)
+Phi = np.exp(-2j*np.pi*project(X_complex))
+G, Phi_H_y = blocked_gram(X_complex, project, y, M, tile_size=256)
+G_true = Phi.conj().T.dot(Phi)
+print('complex X relative l0 error:',
+    np.max(np.abs(G-G_true))/np.max(np.abs(G_true)))
+timer = Timer(lambda:Phi.conj().T.dot(np.exp(-2j*np.pi*project(X))))
+print('numpy needs   ', timer.timeit(time_reps)/time_reps, 's')
+timer = Timer(lambda:blocked_gram(X, project, y, M, tile_size=256))
+print('our algo needs', timer.timeit(time_reps)/time_reps, 's')